@@ -1,3 +1,7 @@
+import math
+import os
+import sys
+
 from pulumi import Config, export, Output, ResourceOptions
 
 from pulumi_gcp import projects, organizations, compute, serviceaccount
@@ -9,8 +13,14 @@ from pulumi_docker import Image, DockerBuild
 from pulumi_kubernetes import Provider
 from pulumi_kubernetes.apps.v1 import Deployment, DeploymentSpecArgs, StatefulSet, StatefulSetSpecArgs
 from pulumi_kubernetes.core.v1 import ContainerArgs, PodSpecArgs, PodTemplateSpecArgs, EnvVarArgs, ContainerPortArgs, \
-                                        ProbeArgs, HTTPGetActionArgs, Service, ServicePortArgs, ServiceSpecArgs
-from pulumi_kubernetes.meta.v1 import LabelSelectorArgs, ObjectMetaArgs
+                                        ProbeArgs, HTTPGetActionArgs, Service, ServicePortArgs, ServiceSpecArgs, \
+                                        AffinityArgs, PodAntiAffinityArgs, PodAffinityTermArgs
+from pulumi_kubernetes.meta.v1 import LabelSelectorArgs, LabelSelectorRequirementArgs, ObjectMetaArgs
+
+import planner
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'k8s', 'apps'))
+from devicestore import DeviceStore  # noqa: E402
 
 # Get the configuration settings from the Pulumi stack
 config = Config()
@@ -20,6 +30,44 @@ BILLING_ACCOUNT = config.get('billing_account')
 PROJECT_NAME = config.get('project_name')
 PROJECT_ID = config.get('project_id')
 WORKER_REPLICAS = config.get_int('worker_replicas')
+WORKER_PROCESSES = config.get_int('worker_processes')
+
+
+def count_devices():
+    # devices in the device list baked into the worker image, the store has the count in its header
+    if os.path.exists('k8s/utils/devicelist.db'):
+        store = DeviceStore('k8s/utils/devicelist.db')
+        try:
+            return len(store)
+        finally:
+            store.close()
+    if os.path.exists('k8s/utils/devicelist.csv'):
+        with open('k8s/utils/devicelist.csv', 'rb') as f:
+            return sum(1 for _ in f)
+    return None
+
+
+# With a target load the cluster is sized by the capacity planner (see planner.py) instead of the values above.
+TARGET_DEVICES = config.get_int('target_devices')
+if TARGET_DEVICES:
+    plan = planner.plan(TARGET_DEVICES,
+                        config.get_float('target_msg_rate') or 0,
+                        devicesPerCore=config.get_float('harness_devices_per_core') or planner.DEFAULT_DEVICES_PER_CORE,
+                        messagesPerCore=config.get_float('harness_msgs_per_core') or planner.DEFAULT_MESSAGES_PER_CORE,
+                        family=config.get('gke_machine_family') or 'e2-standard',
+                        maxNodes=config.get_int('max_nodes') or 50,
+                        utilization=config.get_float('utilization') or 0.7,
+                        memoryPerDeviceKb=config.get_float('memory_per_device_kb') or 64)
+    NODE_COUNT = plan['node_count']
+    MACHINE_TYPE = plan['machine_type']
+    WORKER_REPLICAS = plan['worker_replicas']
+    WORKER_PROCESSES = plan['worker_processes']
+    BLOCK_SIZE = plan['block_size']
+    export('plan', plan)
+else:
+    # every device in the list is assigned, the last pod may get fewer
+    numDevices = count_devices()
+    BLOCK_SIZE = int(math.ceil(numDevices / float(WORKER_REPLICAS))) if numDevices else None
 
 # Create a project for the Locust cluster
 bench_project = organizations.Project(
@@ -236,6 +284,17 @@ service = Service("locust-master",
                                        selector=deployment.spec.apply(lambda spec: spec.template.metadata.labels),),
                   opts=ResourceOptions(provider=gke_provider, depends_on=[deployment]))
 
+# The workers reach the master's ports through a cluster-internal service, by its name. Locust's master ports have no
+# authentication, so they are not on the load balancer.
+MASTER_HOST = "locust-master"
+master_ports = Service("locust-master-ports",
+                       metadata=ObjectMetaArgs(name=MASTER_HOST, labels=deployment.spec.apply(
+                           lambda spec: spec.template.metadata.labels),),
+                       spec=ServiceSpecArgs(type="ClusterIP", ports=[ServicePortArgs(name="p1", port=5557, target_port=5557,),
+                                                                     ServicePortArgs(name="p2", port=5558, target_port=5558,)],
+                                            selector=deployment.spec.apply(lambda spec: spec.template.metadata.labels),),
+                       opts=ResourceOptions(provider=gke_provider, depends_on=[deployment]))
+
 # Save the service IP.
 locust_service_ip = Output.all(service.status).apply(
     lambda status: status[0]['load_balancer']['ingress'][0]['ip'])
@@ -245,10 +304,10 @@ ip = locust_service_ip.apply(lambda v: f"{v}")
 # export the service IP 
 export('locust_service_ip', ip)
 
-# Replace the placeholder in the DockerfileWorker.template with the service IP of the master.
+# Replace the placeholder in the DockerfileWorker.template with the master's service name, resolved by the cluster DNS.
 # Create a Docker image for the Locust worker and push it to the default GCR registry.
 with open("k8s/DockerfileWorker.template", "r") as f:
-    dockerfile = f.read().replace("${masterIP}", "35.184.157.78")
+    dockerfile = f.read().replace("${masterIP}", MASTER_HOST)
 with open("k8s/Dockerfile", "w") as f:
     f.write(dockerfile)
 
@@ -257,31 +316,45 @@ worker = Image(name="locustWorker",
               image_name=bench_project.project_id.apply(lambda project_id: f"gcr.io/{project_id}/locust-worker:latest"),
               opts=ResourceOptions(depends_on=[registry_api]))
 
-# Create deployment for the Locust worker.
+# The pods' sizing, BLOCK_SIZE devices per pod (each pod takes the block of its ordinal) split over WORKER_PROCESSES
+worker_env = [EnvVarArgs(name="LOCUST_MODE", value="worker",)]
+if BLOCK_SIZE:
+    worker_env.append(EnvVarArgs(name="BLOCK_SIZE", value=str(BLOCK_SIZE),))
+if WORKER_PROCESSES:
+    worker_env.append(EnvVarArgs(name="WORKER_PROCESSES", value=str(WORKER_PROCESSES),))
+
+# Create the stateful set for the Locust worker, its pods are named locust-worker-0, locust-worker-1 ...
 deployment = StatefulSet(
     "locust-worker",
-    spec=DeploymentSpecArgs(selector=LabelSelectorArgs(match_labels={
+    metadata=ObjectMetaArgs(name="locust-worker"),
+    spec=StatefulSetSpecArgs(selector=LabelSelectorArgs(match_labels={
         "component": "worker", }),
+        service_name="locust-worker",
+        pod_management_policy="Parallel",
         replicas=WORKER_REPLICAS,
         template=PodTemplateSpecArgs(metadata=ObjectMetaArgs(labels={
             "app": "locust-worker",
             "component": "worker",
         }),
-            spec=PodSpecArgs(containers=[
-                ContainerArgs(name="locust-worker",
-                                image=worker.image_name,
-                                env=[EnvVarArgs(
-                                    name="LOCUST_MODE",
-                                    value="worker",)],
-                                ports=[ContainerPortArgs(name="loc-worker-web", container_port=8089, protocol="TCP",),
-                                        ContainerPortArgs(
-                                            name="loc-worker-p1", container_port=5557, protocol="TCP",),
-                                        ContainerPortArgs(name="loc-worker-p2", container_port=5558, protocol="TCP",), ],
-                                liveness_probe=ProbeArgs(http_get=HTTPGetActionArgs(
-                                    path="/", port=8089,), period_seconds=30,),
-                                readiness_probe=ProbeArgs(http_get=HTTPGetActionArgs(
-                                    path="/", port=8089,), period_seconds=30,)
-                                ), ],),),),
+            # one worker pod per node, as the planner sizes WORKER_PROCESSES for the cores of a node
+            spec=PodSpecArgs(affinity=AffinityArgs(pod_anti_affinity=PodAntiAffinityArgs(
+                required_during_scheduling_ignored_during_execution=[PodAffinityTermArgs(
+                    label_selector=LabelSelectorArgs(match_expressions=[LabelSelectorRequirementArgs(
+                        key="app", operator="In", values=["locust-worker", "locust"],)],),
+                    topology_key="kubernetes.io/hostname",)],),),
+                containers=[
+                    ContainerArgs(name="locust-worker",
+                                    image=worker.image_name,
+                                    env=worker_env,
+                                    ports=[ContainerPortArgs(name="loc-worker-web", container_port=8089, protocol="TCP",),
+                                            ContainerPortArgs(
+                                                name="loc-worker-p1", container_port=5557, protocol="TCP",),
+                                            ContainerPortArgs(name="loc-worker-p2", container_port=5558, protocol="TCP",), ],
+                                    liveness_probe=ProbeArgs(http_get=HTTPGetActionArgs(
+                                        path="/", port=8089,), period_seconds=30,),
+                                    readiness_probe=ProbeArgs(http_get=HTTPGetActionArgs(
+                                        path="/", port=8089,), period_seconds=30,)
+                                    ), ],),),),
     opts=ResourceOptions(
         provider=gke_provider,
         depends_on=[registry_api, worker, gke_cluster]
@@ -0,0 +1,159 @@
+from os import environ as env, path
+from tlsconnect import make_context
+
+"""
+Broker backends: everything in the device behavior that depends on the broker under test.
+
+A backend decides the client id, how a device authenticates, the topic it publishes to, the topic its echoes arrive
+on, and where and how it connects. MQTT_BACKEND selects one:
+
+iotcore - (default) the Cloud IoT Core conventions: client id projects/{project}/locations/{region}/registries/
+{registry}/devices/{deviceId}, a JWT as password, publish to /devices/{deviceId}/events and receive the echoes that
+echoservice sends to /devices/{deviceId}/commands/#, over TLS to mqtt.2030.ltsapis.goog:443.
+
+generic - any MQTT broker (EMQX, HiveMQ, Mosquitto, broker/local/localbroker.py), configured by:
+MQTT_CLIENT_ID - client id template (default {deviceId})
+MQTT_AUTH - none (default), password, jwt or mtls
+MQTT_USERNAME, MQTT_PASSWORD - user name template (default {deviceId}) and password for password auth, jwt auth sends
+  the device's JWT as password
+MQTT_CLIENT_CERT, MQTT_CLIENT_KEY - client certificate and key for mtls, shared by all devices of a worker
+MQTT_EVENTS_TOPIC - publish topic template (default /devices/{deviceId}/events)
+MQTT_COMMANDS_TOPIC - topic filter the echoes arrive on (default /devices/{deviceId}/commands/#)
+MQTT_ECHO - bridge (default) expects an echo service or broker rule to answer on the commands topic, loopback
+  subscribes the device to its own events topic, so the broker's delivery is the echo and no echo service is needed
+
+For both, MQTT_HOST, MQTT_PORT, MQTT_TLS (1 or 0) and MQTT_CA_CERTS override where and how to connect. Templates can
+use {deviceId}, {projectId}, {region} and {registryId}.
+"""
+
+
+def get_env(name, default):
+    # template placeholders that are not set arrive as empty strings
+    return env.get(name) or default
+
+
+class Backend(object):
+
+    name = None
+    defaultHost = 'localhost'
+    defaultPort = 1883
+    defaultTls = False
+    usesJwt = False
+
+    def __init__(self):
+        self.host = get_env('MQTT_HOST', self.defaultHost)
+        self.port = int(get_env('MQTT_PORT', self.defaultPort))
+        self.tls = get_env('MQTT_TLS', '1' if self.defaultTls else '0') == '1'
+        self.caCerts = get_env('MQTT_CA_CERTS', path.join(path.dirname(__file__), "./iot_rootCAs.pem"))
+        self.fields = {
+            'projectId': env.get('PROJECT_ID', ''),
+            'region': env.get('REGION', ''),
+            'registryId': env.get('REGISTRY_ID', ''),
+        }
+
+    def format(self, template, deviceId):
+        return template.format(deviceId=deviceId, **self.fields)
+
+    def tls_context(self):
+        # one context per worker process, see tlsconnect.py
+        return make_context(self.caCerts)
+
+    def client_id(self, deviceId):
+        raise NotImplementedError
+
+    def authenticate(self, client, deviceId, get_jwt):
+        raise NotImplementedError
+
+    def events_topic(self, deviceId):
+        raise NotImplementedError
+
+    def echo_topic(self, deviceId):
+        # the topic filter the device subscribes to for its echoes
+        raise NotImplementedError
+
+    def describe(self):
+        return '{} backend, {}:{}{}'.format(self.name, self.host, self.port, ' with TLS' if self.tls else '')
+
+
+class IotCoreBackend(Backend):
+
+    name = 'iotcore'
+    # Use the long-term support domain, mqtt.googleapis.com should be considered deprecated.
+    # Use of mqtt.googleapis.com requires a different trust bundle, located at https://pki.goog/roots.pem.
+    defaultHost = 'mqtt.2030.ltsapis.goog'
+    defaultPort = 443
+    defaultTls = True
+    usesJwt = True
+
+    def client_id(self, deviceId):
+        return self.format('projects/{projectId}/locations/{region}/registries/{registryId}/devices/{deviceId}', deviceId)
+
+    def authenticate(self, client, deviceId, get_jwt):
+        client.username_pw_set(username='unused', password=get_jwt())
+
+    def events_topic(self, deviceId):
+        return '/devices/{}/events'.format(deviceId)
+
+    def echo_topic(self, deviceId):
+        return '/devices/{}/commands/#'.format(deviceId)
+
+
+class GenericBackend(Backend):
+
+    name = 'generic'
+
+    def __init__(self):
+        super(GenericBackend, self).__init__()
+        self.clientIdTemplate = get_env('MQTT_CLIENT_ID', '{deviceId}')
+        self.auth = get_env('MQTT_AUTH', 'none')
+        self.usesJwt = self.auth == 'jwt'
+        self.username = get_env('MQTT_USERNAME', '{deviceId}')
+        self.password = env.get('MQTT_PASSWORD')
+        self.eventsTemplate = get_env('MQTT_EVENTS_TOPIC', '/devices/{deviceId}/events')
+        self.commandsTemplate = get_env('MQTT_COMMANDS_TOPIC', '/devices/{deviceId}/commands/#')
+        self.echo = get_env('MQTT_ECHO', 'bridge')
+        if self.auth not in ('none', 'password', 'jwt', 'mtls'):
+            raise ValueError('unknown MQTT_AUTH {}'.format(self.auth))
+        if self.echo not in ('bridge', 'loopback'):
+            raise ValueError('unknown MQTT_ECHO {}'.format(self.echo))
+        if self.auth == 'mtls' and not self.tls:
+            raise ValueError('MQTT_AUTH=mtls needs MQTT_TLS=1')
+
+    def tls_context(self):
+        context = super(GenericBackend, self).tls_context()
+        if self.auth == 'mtls':
+            context.load_cert_chain(env['MQTT_CLIENT_CERT'], env.get('MQTT_CLIENT_KEY'))
+        return context
+
+    def client_id(self, deviceId):
+        return self.format(self.clientIdTemplate, deviceId)
+
+    def authenticate(self, client, deviceId, get_jwt):
+        if self.auth == 'password':
+            client.username_pw_set(username=self.format(self.username, deviceId), password=self.password)
+        elif self.auth == 'jwt':
+            client.username_pw_set(username=self.format(self.username, deviceId), password=get_jwt())
+
+    def events_topic(self, deviceId):
+        return self.format(self.eventsTemplate, deviceId)
+
+    def echo_topic(self, deviceId):
+        if self.echo == 'loopback':
+            return self.events_topic(deviceId)
+        return self.format(self.commandsTemplate, deviceId)
+
+    def describe(self):
+        return '{}, auth {}, echo {}'.format(super(GenericBackend, self).describe(), self.auth, self.echo)
+
+
+BACKENDS = {
+    'iotcore': IotCoreBackend,
+    'generic': GenericBackend,
+}
+
+
+def make_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError('unknown MQTT_BACKEND {}, expected one of {}'.format(name, ', '.join(sorted(BACKENDS))))
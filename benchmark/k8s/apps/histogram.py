@@ -0,0 +1,98 @@
+"""
+Mergeable log-bucketed latency histogram (HDR style) with microsecond resolution.
+
+Values below 128 us get a bucket each. Above that, every power of two is split into 64 linear sub-buckets, so a
+bucket's width is at most 1/64 of its value and any recorded latency is reported to within about 1.6%. The bucket
+index is computed with a bit_length and a shift, and counts are kept sparsely in a dict, so a histogram covering
+microseconds to hours stays small.
+
+Histograms with the same layout merge by adding counts, which is how worker deltas are combined on the master.
+encode() flattens a histogram into a list of ints ([count, total, max, index, n, index, n, ...]) that survives
+Locust's msgpack transport to the master.
+"""
+
+SUB_BITS = 7
+SUB_HALF = 1 << (SUB_BITS - 1)
+LINEAR_LIMIT = 1 << SUB_BITS
+
+
+def bucket_index(value):
+    if value < LINEAR_LIMIT:
+        return max(0, value)
+    e = value.bit_length() - SUB_BITS
+    return (e << (SUB_BITS - 1)) + (value >> e)
+
+
+def bucket_range(index):
+    # Returns the (lowest, highest) values that fall into bucket index.
+    if index < LINEAR_LIMIT:
+        return index, index
+    e = (index >> (SUB_BITS - 1)) - 1
+    m = index - (e << (SUB_BITS - 1))
+    return m << e, ((m + 1) << e) - 1
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        i = bucket_index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        # value at or below which p percent of the recorded values fall, reported as the bucket midpoint
+        if self.count == 0:
+            return 0
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                low, high = bucket_range(i)
+                return min((low + high) // 2, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'max': self.max,
+        }
+
+    def encode(self):
+        flat = [self.count, self.total, self.max]
+        for i, n in self.counts.items():
+            flat.append(i)
+            flat.append(n)
+        return flat
+
+    @classmethod
+    def decode(cls, flat):
+        h = cls()
+        h.count, h.total, h.max = flat[0], flat[1], flat[2]
+        for j in range(3, len(flat), 2):
+            h.counts[flat[j]] = flat[j + 1]
+        return h
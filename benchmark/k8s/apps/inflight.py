@@ -0,0 +1,62 @@
+"""
+Per-device window of outstanding (published but not yet echoed) sequence numbers.
+
+Send times live in a fixed-size ring buffer indexed by seqNum % size, next to the seqNum that owns each slot, so
+recording a send, matching an echo (in any order) and expiring the oldest messages are all O(1) and allocate nothing.
+Sequence numbers are assigned in increasing order and, like a TCP send window, a device only sends while the span from
+the oldest outstanding seqNum to the next one is shorter than the ring, so outstanding seqNums never share a slot.
+
+An echo whose slot no longer holds its seqNum (it timed out, or was already matched) is late: ack() returns None.
+"""
+
+
+class InflightWindow(object):
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.seqs = [0] * self.size
+        self.sendTimes = [0.0] * self.size
+        self.count = 0
+        # oldest seqNum that may still be outstanding, and the last one added
+        self.oldest = 1
+        self.newest = 0
+
+    def advance(self):
+        # move oldest past the slots that have been acked
+        while self.oldest <= self.newest and self.seqs[self.oldest % self.size] != self.oldest:
+            self.oldest += 1
+
+    def full(self):
+        self.advance()
+        return self.newest - self.oldest + 1 >= self.size
+
+    def add(self, seqNum, sendTime):
+        slot = seqNum % self.size
+        self.seqs[slot] = seqNum
+        self.sendTimes[slot] = sendTime
+        self.newest = seqNum
+        self.count += 1
+
+    def ack(self, seqNum):
+        # Returns the send time of seqNum and frees its slot, or None if it is not outstanding.
+        slot = seqNum % self.size
+        if seqNum <= 0 or self.seqs[slot] != seqNum:
+            return None
+        self.seqs[slot] = 0
+        self.count -= 1
+        return self.sendTimes[slot]
+
+    def expire(self, now, timeout):
+        # Frees and returns the seqNums sent more than timeout seconds ago, oldest first.
+        expired = []
+        self.advance()
+        while self.oldest <= self.newest:
+            slot = self.oldest % self.size
+            if now - self.sendTimes[slot] < timeout:
+                break
+            self.seqs[slot] = 0
+            self.count -= 1
+            expired.append(self.oldest)
+            self.oldest += 1
+            self.advance()
+        return expired
@@ -0,0 +1,161 @@
+import concurrent.futures
+import sys
+import threading
+import time
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+"""
+Pre-minted JWT cache for the simulated devices.
+
+Signing an RS256 token costs a private key parse plus an RSA signature, which is too slow to do on the greenlet's
+critical path while thousands of devices connect at once. TokenService mints every device's token ahead of time:
+
+load() - submits the devices in chunks to a process pool, newest first, because on_start pops devices from the end of
+the device list. The keys are parsed in the pool, so the worker's gevent hub is not blocked while it hatches
+get() - O(1) dictionary lookup of a ready token; if the device's chunk is still being minted it waits for that chunk,
+and if there is no usable token it signs one in-process, parsing the device's key on first use
+refresher thread - every refreshInterval seconds re-mints the tokens that expire within refreshMargin seconds
+
+Worker processes keep their own cache of parsed keys, so a key is parsed at most once per process even across refreshes.
+Setting processes to 0 mints in the calling process, which is useful where forking is not wanted.
+"""
+
+CHUNK_SIZE = 200
+
+# parsed keys cached in each pool process, keyed by deviceId
+_processKeys = {}
+
+
+def load_key(pem):
+    return serialization.load_pem_private_key(pem.encode('utf-8'), password=None)
+
+
+def sign(key, audience, iat, exp):
+    token = {
+        'iat': iat,
+        'exp': exp,
+        'aud': audience
+    }
+    return jwt.encode(token, key, 'RS256')
+
+
+def mint_chunk(devices, audience, lifetime):
+    # Runs in a pool process. devices is a list of (deviceId, pemKey).
+    iat = int(time.time())
+    exp = iat + lifetime
+    tokens = []
+    for deviceId, pem in devices:
+        key = _processKeys.get(deviceId)
+        if key is None:
+            key = _processKeys[deviceId] = load_key(pem)
+        tokens.append((deviceId, sign(key, audience, iat, exp), exp))
+    return tokens
+
+
+class TokenService(object):
+
+    def __init__(self, audience, lifetimeMinutes=1440, refreshMargin=3600, refreshInterval=60, processes=None):
+        self.audience = audience
+        self.lifetime = lifetimeMinutes * 60
+        # never refresh so early that a fresh token would immediately qualify again
+        self.refreshMargin = min(refreshMargin, self.lifetime // 2)
+        self.refreshInterval = refreshInterval
+        self.pems = {}
+        self.keys = {}
+        self.tokens = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ProcessPoolExecutor(processes) if processes != 0 else None
+        self.numMinted = 0
+        if refreshInterval > 0:
+            refresher = threading.Thread(target=self.run_refresher, name='jwt-refresh')
+            refresher.daemon = True
+            refresher.start()
+
+    def load(self, devices):
+        # devices is a list of (deviceId, pemKey) in the order they will be used from the end
+        startTime = time.time()
+        for deviceId, pem in devices:
+            self.pems[deviceId] = pem
+        self.submit([deviceId for deviceId, _ in reversed(devices)])
+        sys.stdout.write('*** token service loaded {} keys in {:.2f} sec'.format(len(devices), time.time() - startTime))
+
+    def submit(self, deviceIds):
+        if self.pool is None:
+            for deviceId in deviceIds:
+                self.mint_local(deviceId)
+            return
+        for i in range(0, len(deviceIds), CHUNK_SIZE):
+            chunk = [(deviceId, self.pems[deviceId]) for deviceId in deviceIds[i:i + CHUNK_SIZE]]
+            future = self.pool.submit(mint_chunk, chunk, self.audience, self.lifetime)
+            with self.lock:
+                for deviceId, _ in chunk:
+                    self.pending[deviceId] = future
+            future.add_done_callback(self.on_minted)
+
+    def on_minted(self, future):
+        try:
+            tokens = future.result()
+        except Exception as e:
+            # leave the devices without a cached token, get() will sign them in-process
+            sys.stdout.write('*** token service mint failed: {}'.format(e))
+            with self.lock:
+                for deviceId in [d for d, f in self.pending.items() if f is future]:
+                    del self.pending[deviceId]
+            return
+        with self.lock:
+            for deviceId, token, exp in tokens:
+                self.tokens[deviceId] = (token, exp)
+                if self.pending.get(deviceId) is future:
+                    del self.pending[deviceId]
+            self.numMinted += len(tokens)
+
+    def key(self, deviceId):
+        # the parsed key, only needed when minting in-process
+        key = self.keys.get(deviceId)
+        if key is None:
+            key = self.keys[deviceId] = load_key(self.pems[deviceId])
+        return key
+
+    def mint_local(self, deviceId):
+        iat = int(time.time())
+        exp = iat + self.lifetime
+        token = sign(self.key(deviceId), self.audience, iat, exp)
+        with self.lock:
+            self.tokens[deviceId] = (token, exp)
+            self.numMinted += 1
+        return token
+
+    def get(self, deviceId):
+        cached = self.tokens.get(deviceId)
+        if cached is None:
+            future = self.pending.get(deviceId)
+            if future is not None:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+                cached = self.tokens.get(deviceId)
+        if cached is not None and cached[1] - time.time() > self.refreshMargin / 2:
+            return cached[0]
+        return self.mint_local(deviceId)
+
+    def expires(self, deviceId):
+        # exp of the device's cached token, which is the one get() returned unless it has been re-minted since
+        cached = self.tokens.get(deviceId)
+        return cached[1] if cached is not None else time.time() + self.lifetime
+
+    def expiring(self):
+        horizon = time.time() + self.refreshMargin
+        with self.lock:
+            return [deviceId for deviceId, (token, exp) in self.tokens.items()
+                    if exp < horizon and deviceId not in self.pending]
+
+    def run_refresher(self):
+        while True:
+            time.sleep(self.refreshInterval)
+            deviceIds = self.expiring()
+            if deviceIds:
+                sys.stdout.write('*** token service refreshing {} tokens'.format(len(deviceIds)))
+                self.submit(deviceIds)
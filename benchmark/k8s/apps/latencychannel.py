@@ -0,0 +1,91 @@
+import sys
+import threading
+import time
+
+"""
+In-process channel for latency samples.
+
+Stdout is a poor transport for per-message latencies: every sample costs a formatted line and a trip through the
+logging pipeline. The hot path instead puts (kind, deviceIndex, seqNum, latencyUs, timestamp) into a LatencyChannel,
+a fixed-capacity ring of preallocated columns. A drain thread hands the samples in batches, as columns, to each sink
+every flushInterval seconds. If the sinks fall behind and the ring is full, new samples are counted as dropped.
+
+Kinds are the Locust request types: 'MQTT connect' (and its tcp, tls and connack phases), 'MQTT subscribe',
+'MQTT puback' (QoS 1 and 2), 'echo receive' and the echo's hops, 'hop publish', 'hop pubsub', 'hop function' and
+'hop command'.
+
+CsvSink appends the batches to LATENCY_LOG as csv lines: timestamp,kind,deviceIndex,seqNum,latencyUs
+"""
+
+
+class LatencyChannel(object):
+
+    def __init__(self, capacity=65536, flushInterval=1.0):
+        self.capacity = capacity
+        self.kinds = [None] * capacity
+        self.devices = [0] * capacity
+        self.seqs = [0] * capacity
+        self.latencies = [0] * capacity
+        self.times = [0.0] * capacity
+        # head is the number of samples ever put, tail the number ever drained
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.sinks = []
+        self.lock = threading.Lock()
+        self.flushInterval = flushInterval
+        drainer = threading.Thread(target=self.run, name='latency-channel')
+        drainer.daemon = True
+        drainer.start()
+
+    def add_sink(self, sink):
+        # sink(kinds, deviceIndexes, seqNums, latenciesUs, timestamps), called from the drain thread
+        self.sinks.append(sink)
+
+    def put(self, kind, deviceIndex, seqNum, latencyUs, timestamp):
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                self.dropped += 1
+                return
+            i = self.head % self.capacity
+            self.kinds[i] = kind
+            self.devices[i] = deviceIndex
+            self.seqs[i] = seqNum
+            self.latencies[i] = latencyUs
+            self.times[i] = timestamp
+            self.head += 1
+
+    def drain(self):
+        with self.lock:
+            start = self.tail % self.capacity
+            n = self.head - self.tail
+            end = start + n
+            if end <= self.capacity:
+                batch = [column[start:end] for column in (self.kinds, self.devices, self.seqs, self.latencies, self.times)]
+            else:
+                end -= self.capacity
+                batch = [column[start:] + column[:end] for column in (self.kinds, self.devices, self.seqs, self.latencies, self.times)]
+            self.tail = self.head
+        if n:
+            for sink in self.sinks:
+                sink(*batch)
+        return n
+
+    def run(self):
+        while True:
+            time.sleep(self.flushInterval)
+            try:
+                self.drain()
+            except Exception as e:
+                sys.stdout.write('*** latency channel sink failed: {}'.format(e))
+
+
+class CsvSink(object):
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def __call__(self, kinds, devices, seqs, latencies, times):
+        self.file.write(''.join('{:.6f},{},{},{},{}\n'.format(t, k, d, s, l)
+                                for k, d, s, l, t in zip(kinds, devices, seqs, latencies, times)))
+        self.file.flush()
@@ -0,0 +1,95 @@
+import json
+import sys
+import threading
+import time
+from histogram import Histogram
+
+"""
+Latency histograms aggregated from the workers to the Locust master.
+
+On each worker, WorkerHistograms is a LatencyChannel sink that records every connect, subscribe and echo latency (in
+microseconds) into a histogram per request type. When Locust sends its periodic stats report to the master
+(the report_to_master event), the histograms recorded since the previous report are attached to the report as
+encoded deltas under 'ltk_histograms' and a fresh set is started.
+
+On the master, MasterHistograms merges the deltas from every worker (the slave_report event) into a cumulative
+histogram per request type and into the current interval. Every reportInterval seconds the interval is closed and
+p50/p99/p99.9/max for the interval and for the run so far are logged as *** LATENCY lines. The same numbers are
+served as json by the master's web UI at /ltk/latency.
+"""
+
+
+class WorkerHistograms(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.interval = {}
+
+    def __call__(self, kinds, devices, seqs, latencies, times):
+        with self.lock:
+            for kind, latency in zip(kinds, latencies):
+                h = self.interval.get(kind)
+                if h is None:
+                    h = self.interval[kind] = Histogram()
+                h.record(latency)
+
+    def on_report_to_master(self, client_id, data):
+        # pick up the samples still in the channel so they go out with this report
+        self.channel.drain()
+        with self.lock:
+            interval, self.interval = self.interval, {}
+        data['ltk_histograms'] = dict((kind, h.encode()) for kind, h in interval.items())
+
+
+class MasterHistograms(object):
+
+    def __init__(self, reportInterval=10):
+        self.reportInterval = reportInterval
+        self.lock = threading.Lock()
+        self.cumulative = {}
+        self.interval = {}
+        self.lastInterval = {}
+        self.reporter = None
+
+    def on_slave_report(self, client_id, data):
+        deltas = data.get('ltk_histograms')
+        if not deltas:
+            return
+        with self.lock:
+            for kind, flat in deltas.items():
+                delta = Histogram.decode(flat)
+                for hists in (self.cumulative, self.interval):
+                    if kind not in hists:
+                        hists[kind] = Histogram()
+                    hists[kind].merge(delta)
+        if self.reporter is None and self.reportInterval > 0:
+            self.reporter = threading.Thread(target=self.run_reporter, name='latency-report')
+            self.reporter.daemon = True
+            self.reporter.start()
+
+    def rotate(self):
+        with self.lock:
+            self.lastInterval, self.interval = self.interval, {}
+        for scope, hists in (('interval', self.lastInterval), ('total', self.cumulative)):
+            for kind in sorted(hists):
+                s = hists[kind].summary()
+                sys.stdout.write('*** LATENCY {} {} count {} p50 {:.3f} p99 {:.3f} p99.9 {:.3f} max {:.3f} msec'
+                                 .format(kind, scope, s['count'], s['p50'] / 1000.0, s['p99'] / 1000.0,
+                                         s['p99.9'] / 1000.0, s['max'] / 1000.0))
+
+    def run_reporter(self):
+        while True:
+            time.sleep(self.reportInterval)
+            self.rotate()
+
+    def summary(self):
+        # percentiles in microseconds, per request type, for the last closed interval and the run so far
+        with self.lock:
+            return {
+                'interval': dict((kind, h.summary()) for kind, h in self.lastInterval.items()),
+                'total': dict((kind, h.summary()) for kind, h in self.cumulative.items()),
+            }
+
+    def to_json(self):
+        return json.dumps(self.summary(), sort_keys=True)
@@ -0,0 +1,68 @@
+import os
+import signal
+import subprocess
+import sys
+
+"""
+Runs several Locust worker processes in one worker pod.
+
+Usage:
+  python launcher.py locust --slave --master-host MASTER_IP
+
+A single Locust process only uses one core. The launcher starts WORKER_PROCESSES copies of the given command (default
+one per core available to the pod), and each registers with the master as a separate worker. Every process gets
+WORKER_PROCESS (0 to WORKER_PROCESSES-1) in its environment, and locustfile.py uses it to take a disjoint slice of the
+pod's BLOCK_SIZE block, so the processes never share a device.
+
+With BLOCK_SIZE set, no more processes than the block has devices are started, so every process gets a device.
+
+Unless JWT_PROCESSES is set, the cores are also split among the processes' JWT minting pools.
+
+SIGTERM and SIGINT are passed on to the processes, and the launcher exits when all of them have.
+"""
+
+
+def num_processes():
+    try:
+        n = int(os.environ['WORKER_PROCESSES'])
+    except (KeyError, ValueError):
+        n = len(os.sched_getaffinity(0))
+    try:
+        return max(1, min(n, int(os.environ['BLOCK_SIZE'])))
+    except (KeyError, ValueError):
+        return n
+
+
+def main(argv):
+    command = argv[1:]
+    if not command:
+        sys.stderr.write('usage: {} COMMAND [ARGS...]\n'.format(argv[0]))
+        return 2
+    n = num_processes()
+    cores = len(os.sched_getaffinity(0))
+    processes = []
+    for i in range(n):
+        env = dict(os.environ)
+        env['WORKER_PROCESSES'] = str(n)
+        env['WORKER_PROCESS'] = str(i)
+        if not env.get('JWT_PROCESSES'):
+            env['JWT_PROCESSES'] = str(max(1, cores // n))
+        processes.append(subprocess.Popen(command, env=env))
+    print('*** launched {} worker processes on {} cores'.format(n, cores), flush=True)
+
+    def forward(signum, frame):
+        for p in processes:
+            if p.poll() is None:
+                p.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    codes = [p.wait() for p in processes]
+    for i, code in enumerate(codes):
+        if code:
+            print('*** worker process {} exited with code {}'.format(i, code), flush=True)
+    return next((code for code in codes if code), 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
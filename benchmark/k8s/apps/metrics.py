@@ -0,0 +1,224 @@
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from histogram import Histogram, bucket_range
+from mqttloop import get_cpu_time, get_rss
+
+"""
+Live Prometheus (text exposition format 0.0.4) metrics endpoint of a worker process.
+
+Every worker process serves GET /metrics on METRICS_PORT + WORKER_PROCESS, so the processes that launcher.py starts in
+one pod do not collide. The publish path does no extra work for it: counters and gauges are read from the state the
+worker already keeps (ThroughputMeter counts, the devices' connected/ready flags and in-flight windows) when the
+endpoint is scraped, and the latency histograms are filled from the LatencyChannel's drain thread.
+
+ltk_devices{state} - devices started, connected (CONNACK received) and ready (subscribed)
+ltk_inflight_messages - messages published and not yet echoed or timed out
+ltk_messages_total{kind} - offered, sent, acked and echoed messages, use rate() for msg/s
+ltk_latency_seconds{kind} - histogram per request type of the latency channel (echo receive, MQTT connect, hops ...)
+ltk_latency_samples_dropped_total - samples the latency channel dropped because its sinks fell behind
+ltk_mqtt_loop_threads - network loop threads, the MqttLoop threads or one paho loop thread per client
+ltk_threads - threads of the process
+ltk_event_loop_lag_seconds - the largest lateness of a 100 msec sleep over the last second. Under Locust's gevent
+  patching the sleep is a greenlet, so this is how long the hub was busy before it could run the greenlets due
+process_cpu_seconds_total, process_resident_memory_bytes - as in the Prometheus client libraries
+With SOAK_MODE=1 (see soak.py), also:
+ltk_disconnects_total{kind} - planned (token rotation) and unplanned disconnects
+ltk_reconnects_total, ltk_reconnect_failures_total - devices back to ready after a disconnect, and failed attempts
+ltk_devices_down - devices disconnected and not yet back
+ltk_messages_lost_total - QoS 0 messages in flight when their device's connection dropped
+ltk_reconnect_storms_total - report intervals flagged as reconnect storms
+Reconnect latency and outage duration are in ltk_latency_seconds as 'MQTT reconnect' and 'device outage'.
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+LAG_INTERVAL = 0.1
+
+
+class LatencyHistograms(object):
+    # LatencyChannel sink keeping a cumulative histogram per kind, microseconds as recorded.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hists = {}
+
+    def __call__(self, kinds, devices, seqs, latencies, times):
+        with self.lock:
+            for kind, latency in zip(kinds, latencies):
+                h = self.hists.get(kind)
+                if h is None:
+                    h = self.hists[kind] = Histogram()
+                h.record(latency)
+
+    def snapshot(self):
+        # (kind, cumulative counts per bucket bound, count, sum in seconds)
+        with self.lock:
+            hists = [(kind, dict(h.counts), h.count, h.total) for kind, h in self.hists.items()]
+        result = []
+        for kind, counts, count, total in sorted(hists):
+            bounds = [0] * len(BUCKETS)
+            for i, n in counts.items():
+                # a bucket is counted under the first bound its highest value fits, so it is never undercounted
+                high = bucket_range(i)[1] / 1000000.0
+                for b, bound in enumerate(BUCKETS):
+                    if high <= bound:
+                        bounds[b] += n
+                        break
+            cumulative = []
+            seen = 0
+            for n in bounds:
+                seen += n
+                cumulative.append(seen)
+            result.append((kind, cumulative, count, total / 1000000.0))
+        return result
+
+
+class LagProbe(object):
+    # Sleeps LAG_INTERVAL in a loop and keeps the largest oversleep of the last second.
+
+    def __init__(self):
+        self.lag = 0.0
+        self.windowMax = 0.0
+        thread = threading.Thread(target=self.run, name='metrics-lag')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        windowStart = time.time()
+        while True:
+            before = time.time()
+            time.sleep(LAG_INTERVAL)
+            now = time.time()
+            self.windowMax = max(self.windowMax, now - before - LAG_INTERVAL)
+            if now - windowStart >= 1.0:
+                self.lag, self.windowMax = self.windowMax, 0.0
+                windowStart = now
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class WorkerMetrics(object):
+
+    def __init__(self, histograms, get_state):
+        # get_state() returns a dict of the worker globals the metrics read, looked up at scrape time
+        self.histograms = histograms
+        self.get_state = get_state
+        self.devices = []
+        self.lagProbe = LagProbe()
+
+    def add_device(self, device):
+        # called from on_start, the device is only read when scraped
+        self.devices.append(device)
+
+    def render(self):
+        state = self.get_state()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                label = ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+                lines.append('{}{} {}'.format(name, '{' + label + '}' if label else '', value))
+
+        devices = list(self.devices)
+        connected = sum(1 for d in devices if getattr(d, 'connected', False))
+        ready = sum(1 for d in devices if getattr(d, 'ready', False))
+        metric('ltk_devices', 'gauge', 'Simulated devices by state.',
+               [((('state', 'started'),), len(devices)), ((('state', 'connected'),), connected),
+                ((('state', 'ready'),), ready)])
+        inflight = sum(d.window.count for d in devices if getattr(d, 'window', None) is not None)
+        metric('ltk_inflight_messages', 'gauge', 'Messages published and not yet echoed or timed out.', [((), inflight)])
+
+        throughput = state.get('throughput')
+        if throughput is not None:
+            with throughput.lock:
+                counts = [('offered', throughput.offered), ('sent', throughput.sent), ('echoed', throughput.echoed)]
+                if throughput.acks:
+                    counts.append(('acked', throughput.acked))
+            metric('ltk_messages_total', 'counter', 'Messages by stage.', [((('kind', k),), n) for k, n in counts])
+
+        snapshot = self.histograms.snapshot()
+        if snapshot:
+            lines.append('# HELP ltk_latency_seconds Latency by request type.')
+            lines.append('# TYPE ltk_latency_seconds histogram')
+            for kind, cumulative, count, total in snapshot:
+                label = 'kind="{}"'.format(escape(kind))
+                for bound, n in zip(BUCKETS, cumulative):
+                    lines.append('ltk_latency_seconds_bucket{{{},le="{}"}} {}'.format(label, bound, n))
+                lines.append('ltk_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(label, count))
+                lines.append('ltk_latency_seconds_sum{{{}}} {}'.format(label, total))
+                lines.append('ltk_latency_seconds_count{{{}}} {}'.format(label, count))
+        channel = state.get('latencyChannel')
+        if channel is not None:
+            metric('ltk_latency_samples_dropped_total', 'counter', 'Latency samples dropped by the latency channel.',
+                   [((), channel.dropped)])
+
+        soak = state.get('soakMonitor')
+        if soak is not None:
+            with soak.lock:
+                metric('ltk_disconnects_total', 'counter', 'Disconnects of connected devices.',
+                       [((('kind', 'planned'),), soak.rotations),
+                        ((('kind', 'unplanned'),), soak.disconnects - soak.rotations)])
+                metric('ltk_reconnects_total', 'counter', 'Devices back to ready after a disconnect.',
+                       [((), soak.reconnects)])
+                metric('ltk_reconnect_failures_total', 'counter', 'Failed reconnect attempts.', [((), soak.failed)])
+                metric('ltk_devices_down', 'gauge', 'Devices disconnected and not yet back.', [((), soak.down)])
+                metric('ltk_messages_lost_total', 'counter', 'QoS 0 messages in flight at a disconnect.',
+                       [((), soak.lost)])
+                metric('ltk_reconnect_storms_total', 'counter', 'Report intervals flagged as reconnect storms.',
+                       [((), soak.storms)])
+
+        mqttLoops = state.get('mqttLoops')
+        if mqttLoops is not None:
+            loopThreads = len(mqttLoops.loops)
+        else:
+            # paho's loop_start thread, only the threaded engine has one per client
+            loopThreads = sum(1 for d in devices
+                              if getattr(getattr(d, 'mqtt_client', None), '_thread', None) is not None)
+        metric('ltk_mqtt_loop_threads', 'gauge', 'Network loop threads.', [((), loopThreads)])
+        metric('ltk_threads', 'gauge', 'Threads of the process.', [((), threading.active_count())])
+        metric('ltk_event_loop_lag_seconds', 'gauge', 'Largest oversleep of a 100 msec sleep over the last second.',
+               [((), '{:.6f}'.format(self.lagProbe.lag))])
+        metric('process_cpu_seconds_total', 'counter', 'User and system CPU time in seconds.',
+               [((), '{:.3f}'.format(get_cpu_time()))])
+        metric('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes.', [((), get_rss())])
+        return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(metrics, port):
+    # Serves metrics.render() at /metrics on port from a daemon thread.
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not logged
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    sys.stdout.write('*** serving metrics on port {}'.format(port))
+    return server
@@ -0,0 +1,439 @@
+import argparse
+import csv
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+"""
+Microbenchmarks of the worker's hot paths, run offline against an in-memory MQTT client.
+
+Usage (from this directory, in the worker image or anywhere locust and the requirements are installed):
+  python microbench.py [--devices 1000] [--repeat 5] [--save baseline.json] [--compare baseline.json] [--tolerance 0.15]
+
+A temporary device store is built (every device shares one generated key), the real LtkWorker and LtkDevice are
+created from locustfile.py and their MQTT client is replaced by FakeClient, which answers CONNECT and SUBSCRIBE at once
+and keeps each publish, with " ack" appended, as the echo. So what is measured is the harness's own per-message work.
+
+publish - publish_next: payload construction, window bookkeeping and the client call
+on_message - echo parsing, window match, Locust event and latency channel put
+round trip - ltkPublish plus the echo's on_message over the whole device population, reported as messages per CPU
+  second (messages/sec per core); background threads such as the latency channel drain count against it
+get_jwt - the cached token lookup, and jwt sign - an RS256 signature, which is what a token miss costs
+fix_pem_format, load device block (devices/s from devicelist.db), shard device list (devices/s from the csv list)
+harvest binning - analyze.py's driver log parsing and binning, in lines/s (needs numpy and broker/scripts)
+profile schedule - intended send times per second from a workload profile's ProfileSchedule, poisson arrivals along a
+  periodic rate curve plus a burst every second
+
+Each benchmark runs --repeat times and the best rate is kept. A separate pass under tracemalloc reports the memory
+the path retains per op and its peak, so the timing passes are not slowed by tracing.
+
+The environment selects what is measured like it does for the worker, e.g. PAYLOAD_FORMAT=binary, PAYLOAD_SIZE=1024 or
+PUBLISH_QOS=1. --save writes the results as a baseline, --compare checks them against one: a rate more than
+--tolerance below the baseline, or retained memory per op more than --tolerance above it, is reported as a
+*** REGRESSION and the exit status is 1. Baselines only compare on the same machine and settings.
+"""
+
+TARGET_SECONDS = 0.2
+
+
+class FakeMessage(object):
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class FakeInfo(object):
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+class FakeClient(object):
+    # Stands in for PhasedClient: everything the device calls, with no network.
+
+    def __init__(self, client_id='', **kwargs):
+        self.clientIdString = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_message = None
+        self.sessionReused = False
+        self.connectStart = self.tcpDone = self.tlsDone = 0.0
+        self.mid = 0
+        self.echo = True
+        self.inbox = []
+
+    def username_pw_set(self, username=None, password=None):
+        pass
+
+    def tls_share(self, context, resumption=False):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def phases(self):
+        return 0.0, 0.0
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.connectStart = self.tcpDone = self.tlsDone = time.time()
+        self.on_connect(self, None, {}, 0)
+
+    def loop_start(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.mid += 1
+        self.on_subscribe(self, None, self.mid, (qos,))
+        return 0, self.mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.mid += 1
+        if self.echo:
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            self.inbox.append(FakeMessage(topic, bytes(payload) + b' ack'))
+        if qos and self.on_publish:
+            self.on_publish(self, None, self.mid)
+        return FakeInfo(0, self.mid)
+
+    def deliver(self):
+        inbox, self.inbox = self.inbox, []
+        for message in inbox:
+            self.on_message(self, None, message)
+        return len(inbox)
+
+
+class Quiet(object):
+    # stdout for the benchmarks, the worker's log lines are dropped
+
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_store(workDir, numDevices):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import devicestore
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                            serialization.NoEncryption()).decode('ascii')
+    flat = ' '.join(pem.split())
+    with open(os.path.join(workDir, 'devicelist.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(numDevices):
+            writer.writerow(['LTK{:05d}'.format(i + 1), flat])
+    devicestore.build(os.path.join(workDir, 'devicelist.csv'), os.path.join(workDir, 'devicelist.db'))
+    return flat
+
+
+def calibrate(fn):
+    # ops per timing run so a run takes about TARGET_SECONDS
+    n = 1
+    while True:
+        start = time.perf_counter()
+        fn(n)
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_SECONDS / 10 or n >= 1 << 24:
+            return max(1, int(n * TARGET_SECONDS / max(elapsed, 1e-9)))
+        n *= 4
+
+
+def measure(name, fn, repeat, clock=time.perf_counter):
+    # fn(n) runs n ops and returns the number of ops done (or None for n), the best of repeat runs is kept
+    n = calibrate(fn)
+    best = 0.0
+    for _ in range(repeat):
+        gc.collect()
+        start = clock()
+        done = fn(n) or n
+        elapsed = clock() - start
+        best = max(best, done / max(elapsed, 1e-9))
+    # memory pass, on a smaller run
+    m = max(1, min(n, 10000))
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    done = fn(m) or m
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'name': name, 'ops': best, 'retained': max(0, current - before) / done, 'peak': peak - before}
+
+
+def measure_split(name, fn, repeat):
+    # like measure, for a fn(n) that returns (ops, seconds) because it times only part of its work
+    best = 0.0
+    n = 10000
+    for _ in range(repeat):
+        gc.collect()
+        done, elapsed = fn(n)
+        best = max(best, done / max(elapsed, 1e-9))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    done, _ = fn(1000)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'name': name, 'ops': best, 'retained': max(0, current - before) / done, 'peak': peak - before}
+
+
+class Benchmarks(object):
+
+    def __init__(self, numDevices):
+        import jwtcache
+        import locustfile
+        import workload
+        self.jwtcache = jwtcache
+        self.workload = workload
+        self.locustfile = locustfile
+        locustfile.PhasedClient = FakeClient
+        self.worker = locustfile.LtkWorker()
+        self.devices = []
+        for _ in range(numDevices):
+            device = locustfile.LtkDevice(self.worker)
+            device.on_start()
+            self.devices.append(device)
+        self.device = self.devices[0]
+
+    def publish(self, n):
+        d = self.device
+        d.mqtt_client.echo = False
+        topic = d.eventsTopic
+        now = time.time()
+        for _ in range(n):
+            d.publish_next(topic, now)
+            d.window.ack(d.lastSent)
+        d.mqtt_client.echo = True
+
+    def on_message(self, n):
+        # publish in window-sized chunks, only the echoes are timed
+        d = self.device
+        client = d.mqtt_client
+        chunk = max(1, d.window.size - 1)
+        elapsed = 0.0
+        done = 0
+        while done < n:
+            k = min(chunk, n - done)
+            now = time.time()
+            for _ in range(k):
+                d.publish_next(d.eventsTopic, now)
+            messages, client.inbox = client.inbox, []
+            start = time.perf_counter()
+            for message in messages:
+                d.on_message(client, None, message)
+            elapsed += time.perf_counter() - start
+            done += k
+        return done, elapsed
+
+    def round_trip(self, n):
+        done = 0
+        while done < n:
+            for d in self.devices:
+                d.ltkPublish()
+                done += d.mqtt_client.deliver()
+        return done
+
+    def profile_schedule(self, n):
+        profile = self.workload.WorkloadProfile({'classes': [{'rate': 100, 'arrivals': 'poisson',
+                                                             'curve': {'points': [[0, 0.5], [60, 2], [120, 1]],
+                                                                       'period': 120}}],
+                                                'bursts': [{'every': 1, 'jitter': 0.5}]}, origin=0.0)
+        schedule = profile.schedule(profile.classes[0], 0.0)
+        now = 0.0
+        done = 0
+        while done < n:
+            now += 1.0
+            done += len(schedule.due(now))
+        return done
+
+    def get_jwt(self, n):
+        d = self.device
+        for _ in range(n):
+            d.get_jwt()
+
+    def jwt_sign(self, n):
+        service = self.locustfile.tokenService
+        key = service.key(self.device.deviceId)
+        iat = int(time.time())
+        for _ in range(n):
+            self.jwtcache.sign(key, service.audience, iat, iat + 3600)
+
+    def fix_pem_format(self, flat):
+        fix = self.locustfile.fix_pem_format
+
+        def run(n):
+            for _ in range(n):
+                fix(flat)
+        return run
+
+    def load_device_block(self, n):
+        done = 0
+        while done < n:
+            done += len(self.worker.loadDeviceBlock('devicelist.db'))
+        return done
+
+    def shard_device_list(self, rows):
+        lf = self.locustfile
+
+        def run(n):
+            done = 0
+            saved = lf.deviceList
+            try:
+                while done < n:
+                    lf.deviceList = list(rows)
+                    self.worker.shardDeviceList()
+                    done += len(rows)
+            finally:
+                lf.deviceList = saved
+            return done
+        return run
+
+
+def harvest_binning(workDir):
+    # analyze.py is in broker/scripts of the repo, it is not in the worker image
+    scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'broker', 'scripts')
+    sys.path.insert(0, scripts)
+    try:
+        import analyze
+    except ImportError:
+        return None
+    path = os.path.join(workDir, 'driver.log')
+    lines = 200000
+    with open(path, 'w') as f:
+        sendTime = int(time.time() * 100000)
+        for i in range(lines):
+            f.write('[2019-01-04 21:08:53,492] locust-worker-0/INFO/stdout: *** ON_MESSAGE LTK{:05d} 0x7f79587c47d0 '
+                    'payload {} at {} ack latency {} msec\n'.format(i % 1000, i, sendTime + i * 10, i % 900))
+
+    def run(n):
+        done = 0
+        while done < n:
+            analyze.analyze_driver(path)
+            done += lines
+        return done
+    return run
+
+
+def run_all(args):
+    workDir = tempfile.mkdtemp(prefix='microbench-')
+    appsDir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, appsDir)
+    defaults = {
+        'MQTT_BACKEND': 'generic', 'MQTT_TLS': '0', 'MQTT_AUTH': 'jwt', 'MQTT_ENGINE': 'threaded',
+        'LOG_LEVEL': 'error', 'JWT_PROCESSES': '0', 'METRICS_PORT': '0', 'INFLIGHT_WINDOW': '1024',
+        'THROUGHPUT_REPORT_INTERVAL': '0', 'HISTOGRAM_REPORT_INTERVAL': '0', 'RAMP_REPORT_INTERVAL': '0',
+        'BLOCK_SIZE': str(args.devices), 'WORKER_PROCESSES': '1', 'WORKER_PROCESS': '0', 'PROJECT_ID': 'microbench',
+    }
+    for k, v in defaults.items():
+        os.environ.setdefault(k, v)
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    results = []
+    try:
+        flat = make_store(workDir, args.devices)
+        os.chdir(workDir)
+        sys.stdout = Quiet()
+        b = Benchmarks(args.devices)
+        rows = [(d.deviceId, '') for d in b.devices]
+        timed = [
+            ('publish', b.publish),
+            ('get_jwt', b.get_jwt),
+            ('jwt sign', b.jwt_sign),
+            ('fix_pem_format', b.fix_pem_format(flat)),
+            ('load device block', b.load_device_block),
+            ('shard device list', b.shard_device_list(rows)),
+            ('profile schedule', b.profile_schedule),
+        ]
+        binning = harvest_binning(workDir)
+        if binning is not None:
+            timed.append(('harvest binning', binning))
+        for name, fn in timed:
+            results.append(measure(name, fn, args.repeat))
+        results.append(measure_split('on_message', b.on_message, args.repeat))
+        results.append(measure('round trip', b.round_trip, args.repeat, clock=time.process_time))
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for r in results:
+        base = baseline.get('results', {}).get(r['name'])
+        if base is None:
+            r['change'] = None
+            continue
+        r['change'] = r['ops'] / base['ops'] - 1 if base['ops'] else 0.0
+        if r['ops'] < base['ops'] * (1 - tolerance):
+            regressions.append('{} {:.0f} ops/s is {:.1%} below the baseline {:.0f} ops/s'
+                               .format(r['name'], r['ops'], -r['change'], base['ops']))
+        # a few bytes per op is noise from the interpreter's own caches
+        if r['retained'] > base['retained'] * (1 + tolerance) + 16:
+            regressions.append('{} retains {:.0f} bytes/op, baseline {:.0f} bytes/op'
+                               .format(r['name'], r['retained'], base['retained']))
+    return regressions
+
+
+def print_results(results):
+    sys.stdout.write('{:<20} {:>14} {:>10} {:>14} {:>10} {:>9}\n'
+                     .format('benchmark', 'ops/s', 'usec/op', 'retained B/op', 'peak KB', 'vs base'))
+    for r in results:
+        change = r.get('change')
+        sys.stdout.write('{:<20} {:>14,.0f} {:>10.2f} {:>14.1f} {:>10.1f} {:>9}\n'
+                         .format(r['name'], r['ops'], 1000000.0 / r['ops'] if r['ops'] else 0.0, r['retained'],
+                                 r['peak'] / 1024.0, '' if change is None else '{:+.1%}'.format(change)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the worker hot paths.')
+    parser.add_argument('--devices', type=int, default=1000, help='simulated devices for the round trip')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per benchmark, the best is kept')
+    parser.add_argument('--save', help='write the results as a baseline to this file')
+    parser.add_argument('--compare', help='compare the results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown before a regression')
+    args = parser.parse_args(argv[1:])
+
+    results = run_all(args)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.node(),
+                'settings': dict((k, v) for k, v in os.environ.items()
+                                 if k.startswith(('PAYLOAD', 'PUBLISH', 'MQTT_', 'INFLIGHT'))),
+                'results': dict((r['name'], {'ops': r['ops'], 'retained': r['retained']}) for r in results),
+            }, f, indent=2, sort_keys=True)
+        sys.stdout.write('*** baseline written to {}\n'.format(args.save))
+    for line in regressions:
+        sys.stdout.write('*** REGRESSION {}\n'.format(line))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
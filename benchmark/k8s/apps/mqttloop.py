@@ -0,0 +1,198 @@
+import collections
+import resource
+import selectors
+import socket
+import sys
+import threading
+import time
+
+"""
+Multiplexed network loop for the simulated devices.
+
+paho's loop_start() creates one loop thread per client, so a pod with thousands of devices runs thousands of
+threads that mostly sleep in select() on a single socket. An MqttLoop instead drives the sockets of many clients
+from one thread, using paho's external event loop interface:
+
+on_socket_open / on_socket_close - register / unregister the client socket for reading
+on_socket_register_write / on_socket_unregister_write - add / remove write interest when paho has queued data
+loop_read / loop_write - called when the selector reports the socket readable / writable
+loop_misc - called for every client once per second to handle keepalive pings
+
+paho calls the socket callbacks from whichever thread touched the client (e.g. connect() runs in the Locust greenlet,
+publish() in the task), so selector changes requested from outside the loop thread are queued and the loop is woken
+through a socketpair. Changes requested from the loop thread itself are applied immediately.
+
+MqttLoopPool spreads clients round-robin across a small fixed number of loops and reports what the engine achieves:
+devices per core (devices divided by the fraction of a core the process is using) and resident memory per device.
+"""
+
+MISC_INTERVAL = 1.0
+SELECT_TIMEOUT = 0.5
+
+
+def get_rss():
+    # Current resident set size in bytes, falling back to the peak on platforms without /proc.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class MqttLoop(object):
+
+    def __init__(self, name='mqttloop'):
+        self.name = name
+        self.selector = selectors.DefaultSelector()
+        self.clients = set()
+        self.pending = collections.deque()
+        self.wakeR, self.wakeW = socket.socketpair()
+        self.wakeR.setblocking(False)
+        self.wakeW.setblocking(False)
+        self.selector.register(self.wakeR, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self, client):
+        # Must be called before client.connect() so the socket_open callback sees the new socket.
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        self.thread.join()
+
+    def wake(self):
+        try:
+            self.wakeW.send(b'\0')
+        except (BlockingIOError, OSError):
+            # a wakeup is already pending
+            pass
+
+    def request(self, op, client, sock):
+        if threading.current_thread() is self.thread:
+            self.apply(op, client, sock)
+        else:
+            self.pending.append((op, client, sock))
+            self.wake()
+
+    def on_socket_open(self, client, userdata, sock):
+        self.request('open', client, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.request('close', client, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.request('write', client, sock)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.request('unwrite', client, sock)
+
+    def apply(self, op, client, sock):
+        try:
+            if op == 'open':
+                self.clients.add(client)
+                self.selector.register(sock, selectors.EVENT_READ, client)
+            elif op == 'close':
+                self.clients.discard(client)
+                self.selector.unregister(sock)
+            elif op == 'write':
+                self.selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+            else:
+                self.selector.modify(sock, selectors.EVENT_READ, client)
+        except (KeyError, ValueError, OSError):
+            # socket already closed or unregistered, nothing left to watch
+            pass
+
+    def drain_pending(self):
+        while self.pending:
+            op, client, sock = self.pending.popleft()
+            self.apply(op, client, sock)
+
+    def run(self):
+        lastMisc = time.time()
+        while self.running:
+            self.drain_pending()
+            for key, mask in self.selector.select(SELECT_TIMEOUT):
+                client = key.data
+                if client is None:
+                    try:
+                        while self.wakeR.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    client.loop_read()
+                if mask & selectors.EVENT_WRITE:
+                    client.loop_write()
+            now = time.time()
+            if now - lastMisc >= MISC_INTERVAL:
+                lastMisc = now
+                for client in list(self.clients):
+                    client.loop_misc()
+
+
+class MqttLoopPool(object):
+
+    def __init__(self, numLoops=1, reportInterval=60):
+        self.loops = [MqttLoop('mqttloop-{}'.format(i)) for i in range(max(1, numLoops))]
+        self.numAttached = 0
+        self.baseRss = get_rss()
+        self.lastWall = time.time()
+        self.lastCpu = get_cpu_time()
+        self.reportInterval = reportInterval
+        if reportInterval > 0:
+            reporter = threading.Thread(target=self.run_reporter, name='mqttloop-report')
+            reporter.daemon = True
+            reporter.start()
+
+    def run_reporter(self):
+        while True:
+            time.sleep(self.reportInterval)
+            self.report()
+
+    def attach(self, client):
+        self.loops[self.numAttached % len(self.loops)].attach(client)
+        self.numAttached += 1
+
+    def num_devices(self):
+        return sum(len(loop.clients) for loop in self.loops)
+
+    def stats(self):
+        # cpu fraction is measured since the previous call, so each report covers one interval
+        now = time.time()
+        cpu = get_cpu_time()
+        wall = now - self.lastWall
+        cpuFraction = (cpu - self.lastCpu) / wall if wall > 0 else 0.0
+        self.lastWall = now
+        self.lastCpu = cpu
+        devices = self.num_devices()
+        rss = get_rss()
+        return {
+            'loops': len(self.loops),
+            'devices': devices,
+            'cpu_fraction': cpuFraction,
+            'devices_per_core': devices / cpuFraction if cpuFraction > 0 else 0.0,
+            'rss_bytes': rss,
+            'bytes_per_device': (rss - self.baseRss) / devices if devices > 0 else 0.0,
+        }
+
+    def report(self):
+        s = self.stats()
+        sys.stdout.write('*** ENGINE loops {} devices {} cpu {:.2f} cores devices/core {:.0f} rss {} MB memory/device {:.1f} KB'
+                         .format(s['loops'], s['devices'], s['cpu_fraction'], s['devices_per_core'],
+                                 s['rss_bytes'] // (1024 * 1024), s['bytes_per_device'] / 1024))
+        return s
+
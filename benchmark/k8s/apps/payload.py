@@ -0,0 +1,54 @@
+import os
+import struct
+
+"""
+Compact binary payload for PAYLOAD_FORMAT=binary.
+
+The payload is a fixed header followed by padding up to PAYLOAD_SIZE bytes:
+
+magic        4 bytes  b'LTK1'
+deviceIndex  uint32   index of the device in the device list
+seqNum       uint64   sequence number
+sendTime     int64    (intended) send time in nanoseconds since the epoch
+
+Each device owns a bytearray of the full payload size whose padding is copied once, through a memoryview slice, from a
+shared block of random bytes (so the payload does not compress away). Publishing only packs the header into the
+device's buffer in place. paho copies the payload into the outgoing packet before publish() returns, so the buffer can
+be reused for the next QoS 0 message. Parsing reads the header straight out of the received bytes with unpack_from.
+The echo service appends b' ack' after the padding, which parsing ignores.
+"""
+
+MAGIC = b'LTK1'
+HEADER = struct.Struct('<4sIQq')
+MAX_PAYLOAD_SIZE = 256 * 1024
+
+_pad = memoryview(os.urandom(MAX_PAYLOAD_SIZE))
+
+
+def payload_size(size):
+    # the header always fits, padding is capped at MAX_PAYLOAD_SIZE
+    return max(HEADER.size, min(size, MAX_PAYLOAD_SIZE))
+
+
+def make_buffer(size):
+    size = payload_size(size)
+    buf = bytearray(size)
+    buf[HEADER.size:] = _pad[:size - HEADER.size]
+    return buf
+
+
+def pack_into(buf, deviceIndex, seqNum, sendTimeNs):
+    HEADER.pack_into(buf, 0, MAGIC, deviceIndex, seqNum, sendTimeNs)
+
+
+def unpack(data):
+    # Returns (deviceIndex, seqNum, sendTimeNs), or None if data is not a binary payload.
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        return None
+    _, deviceIndex, seqNum, sendTimeNs = HEADER.unpack_from(data, 0)
+    return deviceIndex, seqNum, sendTimeNs
+
+
+def make_text_pad(size):
+    # ascii padding for the text payload, taken from the same random block
+    return ''.join('abcdefghijklmnopqrstuvwxyz0123456789'[b % 36] for b in _pad[:max(0, size)])
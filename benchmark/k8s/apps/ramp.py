@@ -0,0 +1,150 @@
+import sys
+import threading
+import time
+
+"""
+Connection ramp controller for a worker.
+
+Locust's hatch rate decides when a simulated device starts, RampController decides when it may connect. Before
+connecting, a device calls acquire(), which waits for:
+- a token from a bucket filled at rate connects per second (0 = unlimited)
+- a free in-flight slot, at most maxInflight CONNECTs may be waiting for their CONNACK (0 = unlimited)
+and the device reports the CONNACK with done(). A CONNECT without a CONNACK after connectTimeout seconds gives its
+slot back and is counted as failed.
+
+With a rate and a targetLatency (msec), the controller slows down when the broker pushes back: a CONNACK slower than
+the target or with an error code halves the rate (at most once per second, down to 1% of the configured rate), and
+every good CONNACK adds back 2% of the configured rate.
+
+While devices are connecting, the connection-establishment curve is logged every reportInterval seconds:
+*** RAMP elapsed 12.0 connected 1200 failed 0 inflight 35 rate 100.0
+and when every device has been accounted for, the time to connect them all and to reach 50% and 90% of them:
+*** RAMP complete 2000 connected 0 failed in 20.3 sec, 50% at 10.1 sec, 90% at 18.2 sec, 0 slowdowns
+"""
+
+
+class RampController(object):
+
+    def __init__(self, expected, rate=0, maxInflight=0, targetLatency=0, connectTimeout=30, reportInterval=5):
+        self.expected = expected
+        self.baseRate = float(rate)
+        self.rate = float(rate)
+        self.minRate = self.baseRate / 100
+        self.maxInflight = maxInflight
+        self.targetLatency = targetLatency
+        self.connectTimeout = connectTimeout
+        self.reportInterval = reportInterval
+        # a short burst keeps high rates accurate without sleeping for every token
+        self.burst = max(1.0, self.baseRate / 20)
+        self.tokens = 1.0
+        self.lastRefill = time.time()
+        self.lastDecrease = 0
+        self.slowdowns = 0
+        # deviceIndex -> time its CONNECT was allowed
+        self.pending = {}
+        self.connected = 0
+        self.failed = 0
+        self.startTime = None
+        self.curve = []
+        self.lock = threading.Lock()
+        self.reporter = None
+
+    def acquire(self, deviceIndex):
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.startTime is None:
+                    self.start(now)
+                self.expire(now)
+                wait = self.take(now, deviceIndex)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def take(self, now, deviceIndex):
+        # returns 0 if deviceIndex may connect now, otherwise how long to wait before asking again
+        if self.maxInflight and len(self.pending) >= self.maxInflight:
+            return 0.01
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+            self.lastRefill = now
+            if self.tokens < 1.0:
+                return (1.0 - self.tokens) / self.rate
+            self.tokens -= 1.0
+        self.pending[deviceIndex] = now
+        return 0
+
+    def expire(self, now):
+        for deviceIndex, startTime in list(self.pending.items()):
+            if now - startTime > self.connectTimeout:
+                del self.pending[deviceIndex]
+                self.failed += 1
+
+    def done(self, deviceIndex, latency, rc):
+        # latency is the CONNECT to CONNACK time in msec, rc the CONNACK code
+        with self.lock:
+            if self.pending.pop(deviceIndex, None) is None:
+                return
+            if rc == 0:
+                self.connected += 1
+            else:
+                self.failed += 1
+            self.curve.append((time.time() - self.startTime, self.connected))
+            if self.baseRate > 0 and self.targetLatency > 0:
+                self.adapt(latency, rc)
+
+    def release(self, deviceIndex):
+        # the connect failed before a CONNACK could arrive
+        with self.lock:
+            if self.pending.pop(deviceIndex, None) is not None:
+                self.failed += 1
+
+    def adapt(self, latency, rc):
+        now = time.time()
+        if rc != 0 or latency > self.targetLatency:
+            if now - self.lastDecrease >= 1.0:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.lastDecrease = now
+                self.slowdowns += 1
+        elif self.rate < self.baseRate:
+            self.rate = min(self.baseRate, self.rate + self.baseRate / 50)
+
+    def start(self, now):
+        self.startTime = now
+        self.lastRefill = now
+        if self.reportInterval > 0:
+            self.reporter = threading.Thread(target=self.run_reporter, name='ramp-report')
+            self.reporter.daemon = True
+            self.reporter.start()
+
+    def complete(self):
+        return self.connected + self.failed >= self.expected
+
+    def run_reporter(self):
+        last = None
+        while not self.complete():
+            time.sleep(self.reportInterval)
+            # stay quiet while no devices are being started (Locust may run fewer users than devices)
+            state = (self.connected, self.failed, len(self.pending))
+            if state != last:
+                self.report()
+            last = state
+        self.report_complete()
+
+    def report(self):
+        sys.stdout.write('*** RAMP elapsed {:.1f} connected {} failed {} inflight {} rate {:.1f}'
+                         .format(time.time() - self.startTime, self.connected, self.failed, len(self.pending), self.rate))
+
+    def time_to(self, fraction):
+        # seconds from the first CONNECT until fraction of the expected devices were connected
+        target = fraction * self.expected
+        for elapsed, connected in self.curve:
+            if connected >= target:
+                return elapsed
+        return None
+
+    def report_complete(self):
+        marks = ', '.join('{}% at {}'.format(int(f * 100), '{:.1f} sec'.format(t) if t is not None else 'never')
+                          for f, t in ((f, self.time_to(f)) for f in (0.5, 0.9)))
+        sys.stdout.write('*** RAMP complete {} connected {} failed in {:.1f} sec, {}, {} slowdowns'
+                         .format(self.connected, self.failed, self.curve[-1][0] if self.curve else 0.0, marks, self.slowdowns))
@@ -0,0 +1,115 @@
+import random
+import sys
+import threading
+import time
+
+"""
+Open-loop publish scheduling.
+
+In the default closed-loop mode a device waits for the echo of its last message before publishing again, so a slow
+broker lowers the offered load and the measured latencies hide the queueing (coordinated omission). In open-loop mode
+each device follows an ArrivalSchedule of intended send times that does not depend on the echoes:
+
+fixed - one message every 1/rate seconds, starting at a random phase so devices do not publish in lockstep
+poisson - exponentially distributed gaps with mean 1/rate, i.e. a Poisson arrival process
+
+If the device falls behind (e.g. the greenlet was not scheduled in time) it sends every message that has come due,
+and the latency of each one is measured from its intended send time, so the lag shows up in the latencies.
+
+ThroughputMeter counts offered (scheduled), sent and echoed messages (and acknowledged ones with QoS 1 or 2) and logs
+the rates each interval, so the offered and achieved throughput can be compared to find the broker's saturation point.
+"""
+
+
+class ArrivalSchedule(object):
+
+    def __init__(self, rate, arrivals='fixed', start=None):
+        self.rate = float(rate)
+        self.interval = 1.0 / self.rate
+        self.poisson = (arrivals == 'poisson')
+        if start is None:
+            start = time.time()
+        # random phase spreads the fleet's sends over the first interval
+        self.nextTime = start + random.random() * self.interval
+
+    def advance(self):
+        if self.poisson:
+            self.nextTime += random.expovariate(self.rate)
+        else:
+            self.nextTime += self.interval
+
+    def due(self, now):
+        # Returns the intended send times that have come due, oldest first.
+        dueTimes = []
+        while self.nextTime <= now:
+            dueTimes.append(self.nextTime)
+            self.advance()
+        return dueTimes
+
+    def wait_time(self, now):
+        return max(0.0, self.nextTime - now)
+
+
+class ThroughputMeter(object):
+
+    def __init__(self, reportInterval=10, acks=False):
+        self.offered = 0
+        self.sent = 0
+        self.echoed = 0
+        # with QoS 1 or 2, messages acknowledged by the broker and the most sent but not yet acknowledged
+        self.acks = acks
+        self.acked = 0
+        self.maxAwaiting = 0
+        self.lock = threading.Lock()
+        self.lastReport = (time.time(), 0, 0, 0, 0)
+        self.startTime = time.time()
+        self.reportInterval = reportInterval
+        if reportInterval > 0:
+            reporter = threading.Thread(target=self.run_reporter, name='throughput-report')
+            reporter.daemon = True
+            reporter.start()
+
+    def count(self, offered=0, sent=0, echoed=0, acked=0):
+        with self.lock:
+            self.offered += offered
+            self.sent += sent
+            self.echoed += echoed
+            self.acked += acked
+            if self.acks and self.sent - self.acked > self.maxAwaiting:
+                self.maxAwaiting = self.sent - self.acked
+
+    def rates(self):
+        # rates since the previous call
+        now = time.time()
+        with self.lock:
+            current = (now, self.offered, self.sent, self.echoed, self.acked)
+        last = self.lastReport
+        self.lastReport = current
+        elapsed = current[0] - last[0]
+        if elapsed <= 0:
+            return 0.0, 0.0, 0.0, 0.0
+        return tuple((current[k] - last[k]) / elapsed for k in (1, 2, 3, 4))
+
+    def report(self):
+        offered, sent, echoed, acked = self.rates()
+        if self.acks:
+            sys.stdout.write('*** THROUGHPUT offered {:.1f} msg/s sent {:.1f} msg/s acked {:.1f} msg/s echoed {:.1f} msg/s'
+                             ' awaiting ack {} (max {})'
+                             .format(offered, sent, acked, echoed, self.sent - self.acked, self.maxAwaiting))
+        else:
+            sys.stdout.write('*** THROUGHPUT offered {:.1f} msg/s sent {:.1f} msg/s echoed {:.1f} msg/s'
+                             .format(offered, sent, echoed))
+
+    def report_totals(self):
+        elapsed = max(time.time() - self.startTime, 1e-9)
+        sys.stdout.write('*** THROUGHPUT totals offered {} sent {} echoed {} over {:.0f} sec ({:.1f} / {:.1f} / {:.1f} msg/s)'
+                         .format(self.offered, self.sent, self.echoed, elapsed,
+                                 self.offered / elapsed, self.sent / elapsed, self.echoed / elapsed))
+        if self.acks:
+            sys.stdout.write('*** THROUGHPUT totals acked {} ({:.1f} msg/s), at most {} awaiting ack'
+                             .format(self.acked, self.acked / elapsed, self.maxAwaiting))
+
+    def run_reporter(self):
+        while True:
+            time.sleep(self.reportInterval)
+            self.report()
@@ -0,0 +1,121 @@
+import random
+import sys
+import threading
+import time
+
+"""
+Soak mode (SOAK_MODE=1): keeps every device connected through multi-day runs, and reports how well it does.
+
+Without it, a device whose connection drops is reconnected by paho's loop thread (threaded engine only) with the old
+credentials, so once the JWT has expired the device is gone for good, and its in-flight messages only surface as echo
+timeouts. In soak mode a device:
+- rotates its token before it expires: JWT_ROTATE_MARGIN seconds (default 600, at most a quarter of the token lifetime
+  and of JWT_REFRESH_MARGIN) to twice that before the token's exp, spread at random so devices that connected together
+  do not rotate together, it closes its connection and reconnects at once with the token the TokenService has
+  re-minted (or mints one then, if the refresher has not got to it yet). It stops publishing once the rotation has
+  started, and messages still in flight then are not counted as lost
+- reconnects after an unplanned disconnect with exponential backoff and full jitter, a delay drawn between
+  RECONNECT_MIN_DELAY (default 1) and RECONNECT_MIN_DELAY * 2^attempt seconds, capped at RECONNECT_MAX_DELAY (default
+  120), with fresh credentials. The threaded engine's loop thread waits out the delay (see PhasedClient), with the
+  multiplexed engine the device's task reconnects once the delay has passed
+- restores its subscription, since on_connect subscribes on every CONNACK, and keeps its sequence numbers. QoS 0
+  messages that were in flight when the connection dropped cannot be echoed any more, they are counted as 'message
+  lost' on reconnect and their window slots freed, QoS 1/2 messages are resent by paho and still matched
+
+Reconnects are reported as 'MQTT reconnect' (reconnect attempt to CONNACK, next to the 'MQTT reconnect tcp/tls/connack'
+phases) and 'device outage' (disconnect to resubscribed). SoakMonitor counts disconnects (planned rotations and
+unplanned drops), reconnects, failed attempts, lost messages and devices down, and logs them every SOAK_REPORT_INTERVAL
+seconds (default 60) as *** SOAK lines. An interval in which SOAK_STORM_FRACTION (default 0.05) or more of the devices
+started so far dropped their connection within one second, rotations aside, is flagged as a reconnect storm.
+"""
+
+
+def reconnect_delay(attempt, minDelay, maxDelay):
+    # exponential backoff with full jitter, attempt counts from 0
+    return random.uniform(minDelay, min(maxDelay, minDelay * 2 ** min(attempt, 30)))
+
+
+class SoakMonitor(object):
+
+    def __init__(self, reportInterval=60, stormFraction=0.05):
+        # devices started in this process, the storm threshold grows with them
+        self.numDevices = 0
+        self.stormFraction = stormFraction
+        self.stormThreshold = 2
+        self.lock = threading.Lock()
+        # run totals
+        self.disconnects = 0
+        self.rotations = 0
+        self.reconnects = 0
+        self.failed = 0
+        self.lost = 0
+        self.storms = 0
+        self.down = 0
+        # current interval
+        self.interval = [0, 0, 0, 0, 0]
+        self.perSecond = {}
+        self.reportInterval = reportInterval
+        if reportInterval > 0:
+            reporter = threading.Thread(target=self.run_reporter, name='soak-report')
+            reporter.daemon = True
+            reporter.start()
+
+    def started(self):
+        with self.lock:
+            self.numDevices += 1
+            self.stormThreshold = max(2, int(self.numDevices * self.stormFraction))
+
+    def disconnected(self, planned):
+        second = int(time.time())
+        with self.lock:
+            self.disconnects += 1
+            self.down += 1
+            self.interval[0] += 1
+            if planned:
+                self.rotations += 1
+                self.interval[1] += 1
+            else:
+                # only dropped connections make a storm, rotations are spread by schedule_rotation
+                self.perSecond[second] = self.perSecond.get(second, 0) + 1
+
+    def reconnected(self):
+        with self.lock:
+            self.reconnects += 1
+            self.down = max(0, self.down - 1)
+            self.interval[2] += 1
+
+    def reconnect_failed(self):
+        with self.lock:
+            self.failed += 1
+            self.interval[3] += 1
+
+    def messages_lost(self, n):
+        with self.lock:
+            self.lost += n
+            self.interval[4] += n
+
+    def report(self):
+        with self.lock:
+            disconnects, rotations, reconnects, failed, lost = self.interval
+            peak = max(self.perSecond.values()) if self.perSecond else 0
+            storm = peak >= self.stormThreshold
+            if storm:
+                self.storms += 1
+            self.interval = [0, 0, 0, 0, 0]
+            self.perSecond = {}
+            down = self.down
+        sys.stdout.write('*** SOAK disconnects {} (rotations {}) reconnects {} failed {} lost {} down {} of {} '
+                         'peak {} drops/s{}'
+                         .format(disconnects, rotations, reconnects, failed, lost, down, self.numDevices, peak,
+                                 ' RECONNECT STORM' if storm else ''))
+
+    def report_totals(self):
+        sys.stdout.write('*** SOAK totals disconnects {} (rotations {}) reconnects {} failed {} lost {} storms {} '
+                         'down {} of {}'
+                         .format(self.disconnects, self.rotations, self.reconnects, self.failed, self.lost,
+                                 self.storms, self.down, self.numDevices))
+
+    def run_reporter(self):
+        while True:
+            time.sleep(self.reportInterval)
+            self.report()
@@ -0,0 +1,105 @@
+import socket
+import ssl
+import time
+import paho.mqtt.client as mqtt
+
+"""
+Shared TLS context and phase-timed connects for the simulated devices.
+
+tls_set() builds an SSLContext and reads iot_rootCAs.pem for every client. make_context() builds one context per
+worker process instead, and every device's PhasedClient uses it through its own SessionContext.
+
+With resumption on (TLS_RESUMPTION=1), a SessionContext keeps the TLS session of the device's last handshake and
+offers it on the next connect, so reconnects can resume the session (abbreviated handshake) instead of doing a full
+handshake. Sessions are per device, as the broker would see them from a real device.
+
+PhasedClient time-stamps the steps of paho's connect so "MQTT connect" can be split into:
+tcp - socket connect, including the DNS lookup
+tls - TLS handshake
+connack - from the end of the handshake (CONNECT sent) to the CONNACK, measured by the caller in on_connect
+
+PhasedClient also turns off Nagle's algorithm (TCP_NODELAY), which paho leaves on. Otherwise, with more than one
+message in flight, a publish written while the previous one is unacknowledged at the TCP level waits for the broker's
+delayed ACK (about 40 msec on Linux) and the wait shows up as broker latency.
+
+The phases are taken from hooks into paho's reconnect() (_create_socket_connection and _call_socket_open, both
+private), which is written against paho-mqtt 1.x.
+
+With reconnectDelay set to a function returning seconds, the loop thread of loop_start() waits that long before each
+automatic reconnect instead of paho's own doubling delay (_reconnect_wait, private as well), so a device can choose its
+backoff and jitter (see soak.py).
+"""
+
+
+def make_context(caCerts):
+    # same settings as tls_set(ca_certs=caCerts, tls_version=ssl.PROTOCOL_TLSv1_2)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    context.load_verify_locations(caCerts)
+    return context
+
+
+class SessionContext(object):
+    # Stands in for the shared SSLContext in one client, paho only calls wrap_socket and reads check_hostname.
+
+    def __init__(self, context, resumption=False):
+        self.context = context
+        self.resumption = resumption
+        self.session = None
+
+    @property
+    def check_hostname(self):
+        return self.context.check_hostname
+
+    def wrap_socket(self, sock, **kwargs):
+        if self.resumption and self.session is not None:
+            kwargs['session'] = self.session
+        return self.context.wrap_socket(sock, **kwargs)
+
+
+class PhasedClient(mqtt.Client):
+
+    def __init__(self, *args, **kwargs):
+        super(PhasedClient, self).__init__(*args, **kwargs)
+        self.connectStart = None
+        self.tcpDone = None
+        self.tlsDone = None
+        self.sessionReused = False
+        self.reconnectDelay = None
+
+    def tls_share(self, context, resumption=False):
+        self.sessionContext = SessionContext(context, resumption)
+        self.tls_set_context(self.sessionContext)
+
+    def phases(self):
+        # (tcp, tls) of the last connect in seconds, tls is 0 without TLS
+        return self.tcpDone - self.connectStart, self.tlsDone - self.tcpDone
+
+    def _create_socket_connection(self):
+        self.connectStart = time.time()
+        sock = super(PhasedClient, self)._create_socket_connection()
+        self.tcpDone = time.time()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _call_socket_open(self):
+        # called by reconnect() once the handshake is done, just before CONNECT is sent
+        self.tlsDone = time.time()
+        if self._ssl:
+            self.sessionReused = self._sock.session_reused
+            if self.sessionContext.resumption:
+                self.sessionContext.session = self._sock.session
+        super(PhasedClient, self)._call_socket_open()
+
+    def _reconnect_wait(self):
+        if self.reconnectDelay is None:
+            super(PhasedClient, self)._reconnect_wait()
+            return
+        # same exit conditions as paho's wait, so disconnect() and loop_stop() are not held up
+        targetTime = time.time() + self.reconnectDelay()
+        while self._state != mqtt.mqtt_cs_disconnecting and not self._thread_terminate:
+            remaining = targetTime - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 1))
@@ -0,0 +1,60 @@
+import sys
+import threading
+import time
+
+"""
+Leveled, sampled and rate-limited logging for the worker.
+
+LOG_LEVEL selects what reaches stdout:
+error - only failures
+info - per-device lifecycle lines (connect, subscribe, disconnect) and periodic reports
+trace - (default) also the per-message *** TASK / *** ON_MESSAGE lines that harvestData.sh reads
+
+Per-message lines are further thinned by TRACE_SAMPLE (log one message in N, default 1) and TRACE_RATE_LIMIT
+(at most that many lines per second per process, default 0 = unlimited). Callers ask trace() before formatting,
+so a message that is not logged costs a counter increment and, with a rate limit, a clock read.
+"""
+
+ERROR = 0
+INFO = 1
+TRACE = 2
+
+LEVELS = {'error': ERROR, 'info': INFO, 'trace': TRACE}
+
+
+class TraceLog(object):
+
+    def __init__(self, level='trace', sample=1, rateLimit=0):
+        self.level = LEVELS.get(level, TRACE)
+        self.sample = max(1, sample)
+        self.rateLimit = rateLimit
+        self.counter = 0
+        self.tokens = float(rateLimit)
+        self.lastRefill = time.time()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def info(self):
+        return self.level >= INFO
+
+    def trace(self):
+        # True if the caller should write this per-message line
+        if self.level < TRACE:
+            return False
+        self.counter += 1
+        if self.counter % self.sample:
+            return False
+        if self.rateLimit <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(float(self.rateLimit), self.tokens + (now - self.lastRefill) * self.rateLimit)
+            self.lastRefill = now
+            if self.tokens < 1.0:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def write(self, line):
+        sys.stdout.write(line)
@@ -0,0 +1,295 @@
+import json
+import math
+import random
+import time
+
+"""
+Declarative workload profiles: the device fleet as classes with their own publish behavior, rate curves and bursts.
+
+WORKLOAD_PROFILE names a JSON file such as:
+
+{
+  "classes": [
+    {"name": "meter", "share": 0.8, "rate": 0.0167, "payload_size": 200, "arrivals": "poisson",
+     "curve": {"diurnal": {"peak_hour": 19, "trough": 0.3}}},
+    {"name": "tracker", "share": 0.2, "rate": 0.2, "payload_size": 1024, "inflight_window": 8,
+     "curve": {"points": [[0, 0.1], [600, 1], [1800, 1], [1800, 4], [1860, 4], [1860, 1]]}}
+  ],
+  "bursts": [{"every": 60, "at": 0, "jitter": 0.5, "messages": 1}]
+}
+
+A class has:
+share - fraction of the fleet (shares are normalized). A device's class follows from its index in the device list,
+  spread with a golden-ratio sequence, so every pod and worker process gets the same mix and the fleet split is exact
+rate - messages per second per device (default 1), payload_size - bytes (default PAYLOAD_SIZE), arrivals - fixed
+  (default) or poisson gaps, inflight_window - outstanding messages per device (default enough for every message
+  sent within the echo timeout at the class's peak rate)
+mode - open (default) publishes on the class's schedule whether or not its messages were echoed, closed wakes every
+  1/rate seconds and fills its window like the default closed loop, with inflight_window 1 by default, and takes no
+  curve or bursts
+curve - multiplier of the rate over time, linear between points [seconds, multiplier]. Two points at the same time
+  make a step. Times are seconds since the worker loaded the profile (clock "run", default) or since midnight UTC
+  (clock "wall"). With period set the curve repeats, without it the first and last multipliers hold before and after.
+  {"diurnal": {"peak_hour": H, "trough": T}} is a day-long wall clock curve from T at H+12 to 1 at H (UTC hours)
+bursts - synchronized sends on top of the rate: every `every` seconds of the wall clock, offset by `at`, each device
+  sends `messages` messages at a time drawn up to `jitter` seconds after that instant (default 0). Bursts at the top
+  level apply to every open class.
+
+ProfileSchedule has the interface of ArrivalSchedule (see scheduler.py). Intended send times are exact for the curve:
+the next send is where the integral of the rate since the previous one reaches 1 (fixed) or an exponential draw
+(poisson, a non-homogeneous Poisson process), solved per linear segment. Bursts are aligned to the wall clock, so
+devices in different pods burst together. Latency is measured from the intended send time, so when a worker cannot
+keep up with a peak the lag shows up in the latencies instead of lowering the offered load.
+"""
+
+DIURNAL_STEPS = 96
+DAY = 86400.0
+# golden ratio conjugate, consecutive device indexes land far apart in [0, 1)
+SPREAD = 0.6180339887498949
+
+
+class RateCurve(object):
+    # Piecewise-linear rate multiplier over curve time u, optionally periodic.
+
+    def __init__(self, points, period=None, clock='run', origin=0.0):
+        if not points:
+            raise ValueError('a curve needs at least one point')
+        points = sorted(((float(t), float(m)) for t, m in points), key=lambda p: p[0])
+        if any(m < 0 for _, m in points):
+            raise ValueError('curve multipliers must not be negative')
+        if clock not in ('run', 'wall'):
+            raise ValueError('unknown curve clock {}, expected run or wall'.format(clock))
+        self.period = float(period) if period else None
+        if self.period is not None and (points[0][0] < 0 or points[-1][0] > self.period):
+            raise ValueError('the points of a periodic curve must lie within its period')
+        self.points = points
+        # wall clock curves count from the epoch, so midnight UTC is u = 0 mod 86400
+        self.origin = 0.0 if clock == 'wall' else origin
+        self.peak = max(m for _, m in points)
+        # segments (u0, u1, m0, m1) of one period, or the whole curve with open ends
+        if self.period is not None:
+            t0, m0 = points[0]
+            tn, mn = points[-1]
+            # one period from the first point, wrapping from the last point to the first one of the next period
+            segments = [(a[0], b[0], a[1], b[1]) for a, b in zip(points, points[1:])]
+            segments.append((tn, t0 + self.period, mn, m0))
+            segments = [s for s in segments if s[1] > s[0]]
+            self.periodArea = sum((u1 - u0) * (m0 + m1) / 2.0 for u0, u1, m0, m1 in segments)
+            # the wrap shifted back a period covers the start of the period before the first point
+            u0, u1, m0, m1 = segments[-1]
+            self.segments = [(u0 - self.period, u1 - self.period, m0, m1)] + segments
+        else:
+            self.segments = ([(-math.inf, points[0][0], points[0][1], points[0][1])] +
+                             [(a[0], b[0], a[1], b[1]) for a, b in zip(points, points[1:]) if b[0] > a[0]] +
+                             [(points[-1][0], math.inf, points[-1][1], points[-1][1])])
+
+    @classmethod
+    def from_spec(cls, spec, origin):
+        if 'diurnal' in spec:
+            peakHour = float(spec['diurnal'].get('peak_hour', 12))
+            trough = float(spec['diurnal'].get('trough', 0.5))
+            points = []
+            for i in range(DIURNAL_STEPS + 1):
+                u = DAY * i / DIURNAL_STEPS
+                phase = 2 * math.pi * (u / 3600.0 - peakHour) / 24.0
+                points.append((u, trough + (1 - trough) * (1 + math.cos(phase)) / 2.0))
+            return cls(points, period=DAY, clock='wall')
+        return cls(spec.get('points') or [], spec.get('period'), spec.get('clock', 'run'), origin)
+
+    def multiplier(self, t):
+        u = self.local(t - self.origin)
+        for u0, u1, m0, m1 in self.segments:
+            if u0 <= u <= u1:
+                if math.isinf(u0) or math.isinf(u1):
+                    return m0
+                return m0 + (m1 - m0) * (u - u0) / (u1 - u0)
+        return 0.0
+
+    def local(self, u):
+        return u % self.period if self.period is not None else u
+
+    def advance(self, t, area):
+        # Returns the time after t where the integral of the multiplier from t reaches area, None if never.
+        if self.period is not None:
+            if self.periodArea <= 0:
+                return None
+            # skip whole periods first, so a long gap does not walk every segment
+            whole = math.floor(area / self.periodArea)
+            if whole > 0:
+                t += whole * self.period
+                area -= whole * self.periodArea
+        u = t - self.origin
+        base = u - self.local(u)
+        i = 0
+        while True:
+            u0, u1, m0, m1 = self.segments[i]
+            lo = u0 + base
+            hi = u1 + base
+            if u < hi:
+                start = max(u, lo)
+                slope = 0.0 if math.isinf(lo) or math.isinf(hi) else (m1 - m0) / (hi - lo)
+                a = m0 if math.isinf(lo) else m0 + slope * (start - lo)
+                if math.isinf(hi):
+                    if a <= 0:
+                        return None
+                    return self.origin + start + area / a
+                segmentArea = (hi - start) * (a + m1) / 2.0
+                if segmentArea >= area and segmentArea > 0:
+                    # a*x + slope*x^2/2 = area, in the form that stays stable for slope near 0
+                    x = 2.0 * area / (a + math.sqrt(max(0.0, a * a + 2.0 * slope * area)))
+                    return self.origin + start + min(x, hi - start)
+                area -= segmentArea
+                u = hi
+            i += 1
+            if i == len(self.segments):
+                # only periodic curves get here, carry on in the next period
+                i = 0
+                base += self.period
+
+
+class Burst(object):
+
+    def __init__(self, spec):
+        self.every = float(spec['every'])
+        if self.every <= 0:
+            raise ValueError('burst every must be positive')
+        self.at = float(spec.get('at', 0))
+        self.jitter = float(spec.get('jitter', 0))
+        self.messages = int(spec.get('messages', 1))
+        if not 0 <= self.jitter < self.every:
+            raise ValueError('burst jitter must be at least 0 and less than every')
+
+    def next_instant(self, t):
+        # first burst instant after t, on the wall clock
+        return (math.floor((t - self.at) / self.every) + 1) * self.every + self.at
+
+    def peak_rate(self):
+        # messages per second averaged over an echo timeout are bounded by this
+        return self.messages / self.every
+
+
+class DeviceClass(object):
+
+    def __init__(self, spec, bursts, origin, defaultPayloadSize):
+        self.name = spec.get('name') or 'default'
+        self.share = float(spec.get('share', 1))
+        self.rate = float(spec.get('rate', 1))
+        self.mode = spec.get('mode', 'open')
+        self.arrivals = spec.get('arrivals', 'fixed')
+        self.payloadSize = int(spec.get('payload_size', defaultPayloadSize))
+        if self.mode not in ('open', 'closed'):
+            raise ValueError('class {}: unknown mode {}'.format(self.name, self.mode))
+        if self.arrivals not in ('fixed', 'poisson'):
+            raise ValueError('class {}: unknown arrivals {}'.format(self.name, self.arrivals))
+        if self.rate <= 0 or self.share < 0:
+            raise ValueError('class {}: rate must be positive and share not negative'.format(self.name))
+        self.curve = RateCurve.from_spec(spec['curve'], origin) if spec.get('curve') else None
+        self.bursts = [Burst(b) for b in spec.get('bursts', [])]
+        if self.mode == 'closed':
+            if self.curve or self.bursts:
+                raise ValueError('class {}: closed mode takes no curve or bursts'.format(self.name))
+        else:
+            self.bursts += bursts
+        self.inflightWindow = spec.get('inflight_window')
+
+    def peak_rate(self):
+        return self.rate * (self.curve.peak if self.curve else 1.0) + sum(b.peak_rate() for b in self.bursts)
+
+    def window_size(self, skipLimit):
+        if self.inflightWindow:
+            return int(self.inflightWindow)
+        if self.mode == 'closed':
+            return 1
+        return int(self.peak_rate() * skipLimit) + 1 + sum(b.messages for b in self.bursts)
+
+    def describe(self):
+        return '{} ({} {}, {:g} msg/s{}{}, {} bytes)'.format(
+            self.name, self.mode, self.arrivals, self.rate, ' with curve' if self.curve else '',
+            ', {} bursts'.format(len(self.bursts)) if self.bursts else '', self.payloadSize or 'default')
+
+
+class WorkloadProfile(object):
+
+    def __init__(self, spec, defaultPayloadSize=0, origin=None):
+        origin = time.time() if origin is None else origin
+        bursts = [Burst(b) for b in spec.get('bursts', [])]
+        specs = spec.get('classes') or [{}]
+        self.classes = [DeviceClass(c, bursts, origin, defaultPayloadSize) for c in specs]
+        total = sum(c.share for c in self.classes)
+        if total <= 0:
+            raise ValueError('the class shares add up to 0')
+        # upper bounds of the classes in [0, 1)
+        self.bounds = []
+        cumulative = 0.0
+        for c in self.classes:
+            cumulative += c.share / total
+            self.bounds.append(cumulative)
+
+    @classmethod
+    def load(cls, path, defaultPayloadSize=0):
+        with open(path) as f:
+            return cls(json.load(f), defaultPayloadSize)
+
+    def class_of(self, deviceIndex):
+        x = (deviceIndex * SPREAD) % 1.0
+        for c, bound in zip(self.classes, self.bounds):
+            if x < bound:
+                return c
+        return self.classes[-1]
+
+    def max_payload_size(self):
+        return max(c.payloadSize for c in self.classes)
+
+    def schedule(self, deviceClass, start=None):
+        return ProfileSchedule(deviceClass, start)
+
+
+class ProfileSchedule(object):
+    # Intended send times of one open-loop device: the class's rate along its curve, merged with its bursts.
+
+    def __init__(self, deviceClass, start=None):
+        if start is None:
+            start = time.time()
+        self.deviceClass = deviceClass
+        self.rate = deviceClass.rate
+        self.curve = deviceClass.curve
+        self.poisson = deviceClass.arrivals == 'poisson'
+        # random phase spreads the fleet's sends over the first interval, like ArrivalSchedule
+        self.nextTime = self.step(start, random.random())
+        self.bursts = deviceClass.bursts
+        # the wall clock instant of each burst's next round, and when this device sends in it
+        self.burstInstants = [b.next_instant(start) for b in self.bursts]
+        self.nextBursts = [self.jittered(b, instant) for b, instant in zip(self.bursts, self.burstInstants)]
+
+    def step(self, t, fraction=1.0):
+        # next send time after t, fraction of a whole gap for the first one
+        area = (random.expovariate(1.0) if self.poisson else 1.0) * fraction / self.rate
+        if self.curve is None:
+            return t + area
+        return self.curve.advance(t, area)
+
+    def jittered(self, burst, instant):
+        return instant + random.random() * burst.jitter if burst.jitter else instant
+
+    def due(self, now):
+        # Returns the intended send times that have come due, oldest first.
+        dueTimes = []
+        while self.nextTime is not None and self.nextTime <= now:
+            dueTimes.append(self.nextTime)
+            self.nextTime = self.step(self.nextTime)
+        for i, burst in enumerate(self.bursts):
+            while self.nextBursts[i] <= now:
+                dueTimes.extend([self.nextBursts[i]] * burst.messages)
+                self.burstInstants[i] = burst.next_instant(self.burstInstants[i])
+                self.nextBursts[i] = self.jittered(burst, self.burstInstants[i])
+        if self.bursts:
+            dueTimes.sort()
+        return dueTimes
+
+    def wait_time(self, now):
+        times = list(self.nextBursts)
+        if self.nextTime is not None:
+            times.append(self.nextTime)
+        if not times:
+            return 1.0
+        return max(0.0, min(times) - now)
@@ -0,0 +1,123 @@
+import argparse
+import math
+import sys
+
+"""
+Capacity planner: sizes the worker cluster for a target load from the measured capacity of the harness.
+
+Usage:
+  python3 planner.py --devices 100000 --rate 20000 [--devices-per-core 5000] [--messages-per-core 4000] [--format env]
+
+__main__.py calls plan() with the Pulumi config values target_devices, target_msg_rate, harness_devices_per_core,
+harness_msgs_per_core, gke_machine_family, max_nodes and utilization (see the README).
+
+The harness capacity is per core: devices per core is the devices/core of the workers' *** ENGINE lines, messages per
+core is the round trip messages/sec of microbench.py (or the echoed rate per core of a run that was not broker
+bound). The cores needed are the larger of devices / devices per core and rate / messages per core, divided by the
+target utilization (default 0.7) to keep headroom for bursts and the greenlet scheduler.
+
+Each worker pod gets a node of its own (the worker set has pod anti-affinity) and runs one worker process per usable
+core of the node, all cores but one, which is left to the kubelet, logging and the loop threads. One more node runs
+the master. Of the machines of the family whose node count stays within max_nodes and whose memory holds the pod's
+devices at memory_per_device_kb (default 64, the memory/device of the *** ENGINE lines), the one with the fewest vCPUs
+in total is chosen, and of those the one with the fewest nodes.
+BLOCK_SIZE is the devices per pod, rounded up so every device is assigned. A pod never runs more worker processes than
+it has devices, so with small blocks WORKER_PROCESSES is the block size.
+"""
+
+# vCPUs of the machine types of a family, and GB of memory per vCPU
+MACHINE_FAMILIES = {
+    'e2-standard': ((2, 4, 8, 16, 32), 4),
+    'e2-highcpu': ((2, 4, 8, 16, 32), 1),
+    'e2-highmem': ((2, 4, 8, 16), 8),
+    'n2-standard': ((2, 4, 8, 16, 32, 48, 64, 80, 96, 128), 4),
+    'n2-highcpu': ((2, 4, 8, 16, 32, 48, 64, 80, 96), 1),
+    'c2-standard': ((4, 8, 16, 30, 60), 4),
+}
+
+DEFAULT_DEVICES_PER_CORE = 5000
+DEFAULT_MESSAGES_PER_CORE = 4000
+
+
+def usable_cores(vcpus):
+    return max(1, vcpus - 1)
+
+
+def plan(devices, rate, devicesPerCore=DEFAULT_DEVICES_PER_CORE, messagesPerCore=DEFAULT_MESSAGES_PER_CORE,
+         family='e2-standard', maxNodes=50, utilization=0.7, memoryPerDeviceKb=64):
+    if family not in MACHINE_FAMILIES:
+        raise ValueError('unknown machine family {}, expected one of {}'.format(family, ', '.join(sorted(MACHINE_FAMILIES))))
+    if devices <= 0:
+        raise ValueError('the target device count must be positive')
+    cores = max(devices / float(devicesPerCore), rate / float(messagesPerCore)) / utilization
+    sizes, gbPerCpu = MACHINE_FAMILIES[family]
+    choice = None
+    for vcpus in sizes:
+        # no more pods than devices, each pod's block has at least one
+        replicas = min(devices, max(1, int(math.ceil(cores / usable_cores(vcpus)))))
+        blockSize = int(math.ceil(devices / float(replicas)))
+        memoryGb = blockSize * memoryPerDeviceKb / (1024.0 * 1024.0)
+        # fits when the pod's devices leave a GB to the system
+        if replicas + 1 > maxNodes or memoryGb > vcpus * gbPerCpu - 1:
+            continue
+        # the master node is the same machine type, GKE sizes the pool as a whole
+        cost = ((replicas + 1) * vcpus, replicas + 1)
+        if choice is None or cost < choice[0]:
+            choice = (cost, vcpus, replicas, blockSize)
+    if choice is None:
+        raise ValueError('{:.0f} cores for {} devices at {} msg/s do not fit in {} {} nodes'
+                         .format(cores, devices, rate, maxNodes, family))
+    _, vcpus, replicas, blockSize = choice
+    # a process without devices would only register an idle worker with the master
+    processes = min(usable_cores(vcpus), blockSize)
+    return {
+        'cores': cores,
+        'machine_type': '{}-{}'.format(family, vcpus),
+        'node_count': replicas + 1,
+        'worker_replicas': replicas,
+        'worker_processes': processes,
+        'block_size': blockSize,
+        'devices_per_process': int(math.ceil(blockSize / float(processes))),
+        'msg_rate_per_process': rate / float(replicas * processes),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Size the worker cluster for a target load.')
+    parser.add_argument('--devices', type=int, required=True, help='target device count')
+    parser.add_argument('--rate', type=float, default=0, help='target messages per second over all devices')
+    parser.add_argument('--devices-per-core', type=float, default=DEFAULT_DEVICES_PER_CORE)
+    parser.add_argument('--messages-per-core', type=float, default=DEFAULT_MESSAGES_PER_CORE)
+    parser.add_argument('--family', default='e2-standard', choices=sorted(MACHINE_FAMILIES))
+    parser.add_argument('--max-nodes', type=int, default=50)
+    parser.add_argument('--utilization', type=float, default=0.7)
+    parser.add_argument('--memory-per-device-kb', type=float, default=64)
+    parser.add_argument('--format', choices=('text', 'env', 'pulumi'), default='text',
+                        help='env prints the LTK_ settings setupTest.sh reads, pulumi the config commands')
+    args = parser.parse_args(argv[1:])
+    try:
+        p = plan(args.devices, args.rate, args.devices_per_core, args.messages_per_core, args.family, args.max_nodes,
+                 args.utilization, args.memory_per_device_kb)
+    except ValueError as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 1
+    if args.format == 'env':
+        sys.stdout.write('export LTK_NUM_LOCUST_WORKERS={}\nexport LTK_WORKER_PROCESSES={}\n'
+                         .format(p['worker_replicas'], p['worker_processes']))
+    elif args.format == 'pulumi':
+        for key, value in (('target_devices', args.devices), ('target_msg_rate', args.rate),
+                           ('harness_devices_per_core', args.devices_per_core),
+                           ('harness_msgs_per_core', args.messages_per_core)):
+            sys.stdout.write('pulumi config set {} {:g}\n'.format(key, value))
+        sys.stdout.write('pulumi config set gke_machine_family {}\n'.format(args.family))
+    else:
+        sys.stdout.write('{:.1f} cores: {} x {} (one for the master), {} worker pods with {} processes, BLOCK_SIZE {}\n'
+                         '{} devices and {:.1f} msg/s per worker process\n'
+                         .format(p['cores'], p['node_count'], p['machine_type'], p['worker_replicas'],
+                                 p['worker_processes'], p['block_size'], p['devices_per_process'],
+                                 p['msg_rate_per_process']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
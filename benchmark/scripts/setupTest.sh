@@ -99,6 +99,12 @@ echo "# Generated by setupTest.sh, changes will be overwritten when script is ru
 ### Set the master's external IP in DockerfileWorker
 envsubst < gke/DockerfileWorker.template >> gke/DockerfileWorker
 
+### Build the compact device store (workers read only their own block from it instead of the whole csv)
+
+info "Building device store from devicelist.csv"
+python3 apps/devicestore.py devicelist.csv utils/devicelist.db || \
+  errorExit "Unable to build device store"
+
 ### Build the docker image for the Locust worker.
 
 info "Building docker image for Locust worker"
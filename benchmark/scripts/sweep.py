@@ -0,0 +1,173 @@
+import argparse
+import csv
+import itertools
+import os
+import subprocess
+import sys
+import time
+
+"""
+Parameter sweep to find the saturation knee of a broker.
+
+Usage:
+  python3 sweep.py --devices 100,200,400,800 --interval 1,0.5 --payload 0,1024 --qos 0,1 [--duration 60] [--out DIR]
+
+Each step runs Locust headless (locust --no-web) on this machine against the broker configured in the environment
+(MQTT_BACKEND, MQTT_HOST, ... see the README), with one simulated device per Locust user. The devices publish
+open-loop (PUBLISH_MODE=open) so the offered load is devices / interval messages per second whatever the broker
+does. Every combination of interval, payload size and QoS is swept over the device counts in increasing order.
+
+A step's numbers come from Locust's csv stats, taken after the ramp (--reset-stats): achieved echo throughput, echo
+latency percentiles and the error rate (failed requests, including echo timeouts, per message sent). When the error
+rate passes --max-errors, the larger device counts of that combination are skipped.
+
+The knee of a combination is the last step that still
+- keeps the error rate below --max-errors
+- achieves at least --min-efficiency of the offered throughput
+- keeps echo p99 within --max-p99-growth times the p99 of the combination's first step
+The results table is printed, marking the knee steps, and written to DIR/sweep.csv with each step's Locust csv files.
+
+Every step needs as many devices in devicelist.db (or devicelist.csv) in --apps-dir as its device count.
+"""
+
+ECHO = 'echo receive'
+FAILURE_TYPES = ('echo timeout', 'echo late', 'last message timeout', 'wrong client', 'MQTT connect', 'MQTT subscribe')
+COLUMNS = ['devices', 'interval', 'payload', 'qos', 'offered', 'achieved', 'p50', 'p99', 'p999', 'errors', 'knee']
+
+
+def parse_list(value, kind):
+    return [kind(v) for v in value.split(',') if v]
+
+
+def read_stats(prefix):
+    # Locust's {prefix}_stats.csv, one row per request type, keyed by the "Type" (request type) column
+    rows = {}
+    with open(prefix + '_stats.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            rows[row.get('Type') or row.get('Method')] = row
+    return rows
+
+
+def number(row, *keys):
+    for key in keys:
+        value = row.get(key)
+        if value not in (None, '', 'N/A'):
+            return float(value)
+    return 0.0
+
+
+def step_result(stats, devices, interval, payload, qos):
+    echo = stats.get(ECHO, {})
+    failures = sum(number(stats.get(t, {}), '# failures', 'Failure Count') for t in FAILURE_TYPES)
+    echoed = number(echo, '# requests', 'Request Count')
+    return {
+        'devices': devices,
+        'interval': interval,
+        'payload': payload,
+        'qos': qos,
+        'offered': devices / interval,
+        'achieved': number(echo, 'Requests/s'),
+        'p50': number(echo, '50%', 'Median response time'),
+        'p99': number(echo, '99%'),
+        'p999': number(echo, '99.9%'),
+        'errors': failures / max(echoed + failures, 1),
+        'knee': '',
+    }
+
+
+def run_step(args, devices, interval, payload, qos, prefix):
+    env = dict(os.environ)
+    # a fleet-wide rate would override the per-device interval of the step
+    env.pop('FLEET_PUBLISH_RATE', None)
+    env.update({
+        'PUBLISH_MODE': 'open',
+        'PUBLISH_RATE': repr(1.0 / interval),
+        'PAYLOAD_SIZE': str(payload),
+        'PUBLISH_QOS': str(qos),
+        'SUBSCRIBE_QOS': str(qos),
+        'LOG_LEVEL': env.get('LOG_LEVEL') or 'info',
+    })
+    hatchRate = max(1, int(devices / args.ramp))
+    command = ['locust', '-f', 'locustfile.py', '--no-web', '-c', str(devices), '-r', str(hatchRate),
+               '-t', '{}s'.format(int(args.ramp + args.duration)), '--reset-stats', '--csv', prefix] + args.locust_arg
+    with open(prefix + '.log', 'w') as log:
+        subprocess.run(command, cwd=args.apps_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return step_result(read_stats(prefix), devices, interval, payload, qos)
+
+
+def mark_knee(results, args):
+    # last step of a combination that is still within all three limits
+    knee = None
+    for r in results:
+        if (r['errors'] > args.max_errors or r['achieved'] < args.min_efficiency * r['offered']
+                or (results[0]['p99'] and r['p99'] > args.max_p99_growth * results[0]['p99'])):
+            break
+        knee = r
+    if knee is not None:
+        knee['knee'] = '*'
+    return knee
+
+
+def print_table(results):
+    sys.stdout.write('{:>8} {:>8} {:>8} {:>3} {:>10} {:>10} {:>8} {:>8} {:>8} {:>7} {}\n'
+                     .format('devices', 'interval', 'payload', 'qos', 'offered/s', 'echoed/s', 'p50', 'p99', 'p99.9',
+                             'errors', 'knee'))
+    for r in results:
+        sys.stdout.write('{devices:>8} {interval:>8g} {payload:>8} {qos:>3} {offered:>10.1f} {achieved:>10.1f} '
+                         '{p50:>8.0f} {p99:>8.0f} {p999:>8.0f} {errPct:>6.2f}% {knee}\n'
+                         .format(errPct=r['errors'] * 100, **r))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Sweep device count, publish interval, payload size and QoS.')
+    parser.add_argument('--devices', required=True, help='comma separated device counts, swept in increasing order')
+    parser.add_argument('--interval', default='1', help='comma separated seconds between publishes per device')
+    parser.add_argument('--payload', default='0', help='comma separated payload sizes in bytes, 0 for unpadded')
+    parser.add_argument('--qos', default='0', help='comma separated publish and subscribe QoS')
+    parser.add_argument('--duration', type=float, default=60, help='measured seconds per step, after the ramp')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds to start all devices of a step')
+    parser.add_argument('--max-errors', type=float, default=0.01, help='error rate that ends a combination')
+    parser.add_argument('--min-efficiency', type=float, default=0.95, help='achieved / offered throughput at the knee')
+    parser.add_argument('--max-p99-growth', type=float, default=3.0, help='p99 growth over the first step at the knee')
+    parser.add_argument('--apps-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'k8s', 'apps'))
+    parser.add_argument('--out', default='sweep-{}'.format(time.strftime('%Y%m%dT%H%M%S')))
+    parser.add_argument('--locust-arg', action='append', default=[], help='extra argument passed to locust')
+    args = parser.parse_args(argv[1:])
+
+    deviceCounts = sorted(parse_list(args.devices, int))
+    os.makedirs(args.out, exist_ok=True)
+    out = os.path.abspath(args.out)
+    allResults = []
+    knees = []
+    for interval, payload, qos in itertools.product(parse_list(args.interval, float), parse_list(args.payload, int),
+                                                     parse_list(args.qos, int)):
+        results = []
+        for devices in deviceCounts:
+            prefix = os.path.join(out, 'step_d{}_i{:g}_p{}_q{}'.format(devices, interval, payload, qos))
+            sys.stdout.write('*** running {} devices, interval {:g} sec, payload {} bytes, qos {}\n'
+                             .format(devices, interval, payload, qos))
+            sys.stdout.flush()
+            r = run_step(args, devices, interval, payload, qos, prefix)
+            results.append(r)
+            if r['errors'] > args.max_errors:
+                sys.stdout.write('*** error rate {:.2%} over {:.2%}, skipping larger device counts\n'
+                                 .format(r['errors'], args.max_errors))
+                break
+        knee = mark_knee(results, args)
+        if knee is not None:
+            knees.append(knee)
+        allResults.extend(results)
+
+    with open(os.path.join(out, 'sweep.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(allResults)
+    print_table(allResults)
+    for knee in knees:
+        sys.stdout.write('*** knee at {devices} devices for interval {interval:g} payload {payload} qos {qos}: '
+                         '{achieved:.1f} msg/s echoed, p99 {p99:.0f} msec\n'.format(**knee))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,44 +1,114 @@
 import functions_framework
 from googleapiclient import discovery
+import google.auth
+import google_auth_httplib2
+import httplib2
 import base64
+import os
+import threading
+import time
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+
+# The API client is built on the first invocation and reused by every later invocation on this instance, so the
+# discovery document is fetched once per instance instead of once per message.
+api_client = None
+credentials = None
+client_lock = threading.Lock()
+
+# Commands of a multi-message delivery are sent concurrently, each sending thread keeps its own connection.
+send_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('SEND_CONCURRENCY') or 8))
+thread_local = threading.local()
 
 
 # Triggered from a message on a Cloud Pub/Sub topic.
 @functions_framework.cloud_event
 def echoservice(cloud_event):
+    start = time.time()
+    receive_us = int(start * 1000000)
+
+    # A delivery normally holds one message, batched deliveries hold a list of them.
+    messages = cloud_event.data.get("messages") or [cloud_event.data["message"]]
+    commands = [decode_message(message) + ((publish_time_us(message) or receive_us, receive_us),) for message in messages]
+    decoded = time.time()
+
+    # Get the API client
+    client = get_api_client()
+    acquired = time.time()
+
+    # Send the commands to the devices
+    if len(commands) == 1:
+        send_command(client, *commands[0])
+    else:
+        list(send_pool.map(lambda command: send_command(client, *command), commands))
+    sent = time.time()
+
+    print('*** timing decode {:.1f} client {:.1f} send {:.1f} msec for {} messages'
+          .format((decoded - start) * 1000, (acquired - decoded) * 1000, (sent - acquired) * 1000, len(commands)))
+
+
+def decode_message(message):
 
     # Extract attributes received from the payload needed to send a command to the device.
-    device_attributes = cloud_event.data["message"]["attributes"]
+    device_attributes = message["attributes"]
     device_id = device_attributes.get('deviceId')
     registry_id = device_attributes['deviceRegistryId']
     project_id = device_attributes['projectId']
     region = device_attributes['deviceRegistryLocation']
 
     # Build message to send back to device
-    device_message = cloud_event.data["message"]["data"]
-    device_message = base64.b64decode(device_message).decode('utf-8')
+    # Kept as bytes, the payload is either text or the binary format (struct header plus padding)
+    device_message = base64.b64decode(message["data"])
 
     # Append ack to message
-    message_to_send = device_message + ' ack'
+    message_to_send = device_message + b' ack'
+    print('Sending message: {}'.format(message_to_send[:64]))
+    return device_id, registry_id, project_id, region, message_to_send
 
-    # Get the API client
-    api_client = discovery.build(
-        'cloudiot', 'v1', discoveryServiceUrl=(
-            'https://cloudiot.googleapis.com/$discovery/rest'))
 
-    # Send the command to the device
-    print('Sending message: {}'.format(message_to_send))
-    send_command(api_client, device_id, registry_id, project_id, region,
-                 message_to_send)
+def publish_time_us(message):
+    # Pub/Sub publish time, RFC 3339 in UTC, e.g. 2019-01-04T21:08:53.492Z, as epoch microseconds
+    published = message.get("publishTime") or message.get("publish_time")
+    if not published:
+        return 0
+    seconds, _, fraction = published.rstrip('Z').partition('.')
+    return (timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S')) * 1000000
+            + int((fraction + '000000')[:6]))
+
+
+def get_api_client():
+    global api_client
+    global credentials
+    with client_lock:
+        if api_client is None:
+            credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+            api_client = discovery.build(
+                'cloudiot', 'v1', credentials=credentials, cache_discovery=False, discoveryServiceUrl=(
+                    'https://cloudiot.googleapis.com/$discovery/rest'))
+    return api_client
+
+
+def get_http():
+    # httplib2 is not thread safe, so every thread gets its own authorized Http, which keeps its connection open
+    # between commands.
+    http = getattr(thread_local, 'http', None)
+    if http is None:
+        http = thread_local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    return http
+
 
+def send_command(client, device_id, registry_id, project_id, region, command, timestamps=None):
 
-def send_command(client, device_id, registry_id, project_id, region, command):
-    
     # Send a command to a device.
+    # With timestamps (Pub/Sub publish and function receive time), the command carries ' hops <publish> <receive>
+    # <dispatch>' in epoch microseconds, which the worker uses to split the round trip into hops.
     parent_name = 'projects/{}/locations/{}'.format(project_id, region)
     registry_name = '{}/registries/{}'.format(parent_name, registry_id)
-    binary_data = command.encode('utf-8')
-    binary_data = base64.b64encode(command.encode('utf-8'))
+    if isinstance(command, str):
+        command = command.encode('utf-8')
+    if timestamps is not None:
+        command += ' hops {} {} {}'.format(timestamps[0], timestamps[1], int(time.time() * 1000000)).encode('utf-8')
+    binary_data = base64.b64encode(command)
     binary_data = binary_data.decode('utf-8')
 
     request = {
@@ -47,4 +117,4 @@ def send_command(client, device_id, registry_id, project_id, region, command):
     }
 
     client.projects().locations().registries().devices().sendCommandToDevice(
-        name=request['name'], body=request).execute()
+        name=request['name'], body=request).execute(http=get_http())
@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import random
+import ssl
+import struct
+import sys
+import time
+
+"""
+Self-contained MQTT broker and echo service stand-in, for running the harness without GCP.
+
+Usage:
+  python3 localbroker.py [--port 1883] [--certfile cert.pem --keyfile key.pem] [--delay-ms 0] [--jitter-ms 0] [--loss 0]
+
+A minimal MQTT 3.1.1 broker on asyncio (Python 3.7+). Every CONNECT is accepted: the client id, user name and JWT
+password are not checked against a registry. Subscriptions support the + and # wildcards, publishes are routed to
+every matching subscription at QoS 0 or 1, and QoS 1 and 2 publishes from clients are acknowledged. There are no
+retained messages, wills or persistent sessions.
+
+The echo bridge does what echoservice (broker/apps/main.py) does: a message published to /devices/{id}/events is
+sent back, with " ack" appended, to /devices/{id}/commands, which the devices subscribe to as
+/devices/{id}/commands/#. Like echoservice, the echo also carries " hops <publish> <receive> <dispatch>" timestamps,
+here the broker's receive time twice and the time the echo is sent. Each echo can be delayed by --delay-ms plus up to --jitter-ms, and dropped with
+probability --loss, to see how the harness reports a slow or lossy echo path.
+
+With --certfile and --keyfile the broker listens with TLS. Point the workers at it with MQTT_HOST, MQTT_PORT,
+MQTT_TLS=0 (or MQTT_CA_CERTS for a self-signed certificate), see the README.
+
+Connection and message counts are printed every --report-interval seconds.
+"""
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        if n:
+            byte |= 0x80
+        out.append(byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(s):
+    return struct.pack('!H', len(s)) + s
+
+
+def packet(first, body):
+    return bytes([first]) + encode_length(len(body)) + body
+
+
+def topic_matches(topicFilter, topic):
+    filterLevels = topicFilter.split(b'/')
+    levels = topic.split(b'/')
+    for i, f in enumerate(filterLevels):
+        if f == b'#':
+            return True
+        if i >= len(levels) or (f != b'+' and f != levels[i]):
+            return False
+    return len(filterLevels) == len(levels)
+
+
+class Subscriptions(object):
+    # Exact topics and 'prefix/#' filters (the devices' commands subscriptions) are found with dictionary lookups,
+    # only other wildcard filters are matched one by one.
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.wildcards = {}
+
+    def index(self, topicFilter):
+        if b'+' not in topicFilter and b'#' not in topicFilter:
+            return self.exact, topicFilter
+        if topicFilter.endswith(b'/#') and b'+' not in topicFilter and b'#' not in topicFilter[:-2]:
+            return self.prefixes, topicFilter[:-2]
+        return self.wildcards, topicFilter
+
+    def add(self, topicFilter, session, qos):
+        table, key = self.index(topicFilter)
+        table.setdefault(key, {})[session] = qos
+
+    def remove(self, topicFilter, session):
+        table, key = self.index(topicFilter)
+        sessions = table.get(key)
+        if sessions is not None:
+            sessions.pop(session, None)
+            if not sessions:
+                del table[key]
+
+    def match(self, topic):
+        # yields (session, qos) for every subscription matching topic
+        for session, qos in self.exact.get(topic, {}).items():
+            yield session, qos
+        # 'a/b/#' matches a/b and everything below it
+        level = topic
+        while True:
+            for session, qos in self.prefixes.get(level, {}).items():
+                yield session, qos
+            cut = level.rfind(b'/')
+            if cut < 0:
+                break
+            level = level[:cut]
+        for topicFilter, sessions in self.wildcards.items():
+            if topic_matches(topicFilter, topic):
+                for session, qos in sessions.items():
+                    yield session, qos
+
+
+class Session(object):
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.clientId = None
+        self.filters = set()
+        self.nextId = 0
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def deliver(self, topic, payload, qos):
+        if qos == 0:
+            self.send(packet(0x30, encode_string(topic) + payload))
+        else:
+            # no retransmission, the client's PUBACK is read and ignored
+            self.nextId = self.nextId % 65535 + 1
+            self.send(packet(0x32, encode_string(topic) + struct.pack('!H', self.nextId) + payload))
+
+    async def read_packet(self):
+        first = (await self.reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b''
+        return first >> 4, first & 0x0f, body
+
+    async def run(self):
+        try:
+            packetType, flags, body = await self.read_packet()
+            if packetType != CONNECT:
+                return
+            self.on_connect(body)
+            while True:
+                packetType, flags, body = await self.read_packet()
+                if packetType == PUBLISH:
+                    self.on_publish(flags, body)
+                elif packetType == PUBREL:
+                    self.send(packet(0x70, body[:2]))
+                elif packetType == SUBSCRIBE:
+                    self.on_subscribe(body)
+                elif packetType == UNSUBSCRIBE:
+                    self.on_unsubscribe(body)
+                elif packetType == PINGREQ:
+                    self.send(b'\xd0\x00')
+                elif packetType == DISCONNECT:
+                    return
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self.broker.disconnected(self)
+            self.writer.close()
+
+    def on_connect(self, body):
+        # protocol name, level, flags and keep alive, then the client id, the user name and password are not checked
+        nameLength = struct.unpack_from('!H', body)[0]
+        pos = 2 + nameLength + 4
+        idLength = struct.unpack_from('!H', body, pos)[0]
+        self.clientId = body[pos + 2:pos + 2 + idLength]
+        self.broker.connected(self)
+        self.send(b'\x20\x02\x00\x00')
+
+    def on_publish(self, flags, body):
+        qos = (flags >> 1) & 3
+        topicLength = struct.unpack_from('!H', body)[0]
+        topic = body[2:2 + topicLength]
+        pos = 2 + topicLength
+        if qos:
+            packetId = body[pos:pos + 2]
+            pos += 2
+            self.send(packet(0x40 if qos == 1 else 0x50, packetId))
+        self.broker.publish(topic, body[pos:])
+
+    def on_subscribe(self, body):
+        packetId = body[:2]
+        pos = 2
+        granted = bytearray()
+        while pos < len(body):
+            filterLength = struct.unpack_from('!H', body, pos)[0]
+            topicFilter = body[pos + 2:pos + 2 + filterLength]
+            qos = min(body[pos + 2 + filterLength] & 3, 1)
+            pos += 3 + filterLength
+            self.broker.subscriptions.add(topicFilter, self, qos)
+            self.filters.add(topicFilter)
+            granted.append(qos)
+        self.send(packet(0x90, packetId + bytes(granted)))
+
+    def on_unsubscribe(self, body):
+        pos = 2
+        while pos < len(body):
+            filterLength = struct.unpack_from('!H', body, pos)[0]
+            topicFilter = body[pos + 2:pos + 2 + filterLength]
+            pos += 2 + filterLength
+            self.broker.subscriptions.remove(topicFilter, self)
+            self.filters.discard(topicFilter)
+        self.send(packet(0xb0, body[:2]))
+
+
+class LocalBroker(object):
+
+    def __init__(self, delayMs=0, jitterMs=0, loss=0.0):
+        self.delay = delayMs / 1000.0
+        self.jitter = jitterMs / 1000.0
+        self.loss = loss
+        self.subscriptions = Subscriptions()
+        self.sessions = {}
+        self.received = 0
+        self.delivered = 0
+        self.echoed = 0
+        self.dropped = 0
+
+    def connected(self, session):
+        # a second connection with the same client id takes over the session, as on the IoT Core bridge
+        old = self.sessions.get(session.clientId)
+        if old is not None:
+            old.writer.close()
+        self.sessions[session.clientId] = session
+
+    def disconnected(self, session):
+        for topicFilter in session.filters:
+            self.subscriptions.remove(topicFilter, session)
+        session.filters.clear()
+        if self.sessions.get(session.clientId) is session:
+            del self.sessions[session.clientId]
+
+    def publish(self, topic, payload):
+        self.received += 1
+        for session, qos in self.subscriptions.match(topic):
+            session.deliver(topic, payload, qos)
+            self.delivered += 1
+        if topic.startswith(b'/devices/') and topic.endswith(b'/events'):
+            self.echo(topic[:-len(b'/events')] + b'/commands', payload + b' ack', int(time.time() * 1000000))
+
+    def echo(self, topic, payload, receiveUs):
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.echoed += 1
+        delay = self.delay + (random.random() * self.jitter if self.jitter else 0)
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self.send_echo, topic, payload, receiveUs)
+        else:
+            self.send_echo(topic, payload, receiveUs)
+
+    def send_echo(self, topic, payload, receiveUs):
+        payload += ' hops {} {} {}'.format(receiveUs, receiveUs, int(time.time() * 1000000)).encode('utf-8')
+        for session, qos in self.subscriptions.match(topic):
+            session.deliver(topic, payload, qos)
+            self.delivered += 1
+
+    async def handle(self, reader, writer):
+        await Session(self, reader, writer).run()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print('*** {} connections, received {} delivered {} echoed {} dropped {}'
+                  .format(len(self.sessions), self.received, self.delivered, self.echoed, self.dropped), flush=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local MQTT broker with the echo service built in.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--certfile', help='serve TLS with this certificate chain')
+    parser.add_argument('--keyfile', help='private key for --certfile')
+    parser.add_argument('--delay-ms', type=float, default=0, help='added to every echo')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='random extra echo delay, up to this much')
+    parser.add_argument('--loss', type=float, default=0, help='probability of dropping an echo')
+    parser.add_argument('--report-interval', type=float, default=10)
+    args = parser.parse_args(argv[1:])
+
+    context = None
+    if args.certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.certfile, args.keyfile)
+    broker = LocalBroker(args.delay_ms, args.jitter_ms, args.loss)
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(broker.handle, args.host, args.port, ssl=context,
+                                                          backlog=4096))
+    print('*** local broker listening on {}:{}{}'.format(args.host, args.port, ' with TLS' if context else ''),
+          flush=True)
+    if args.report_interval > 0:
+        loop.create_task(broker.report(args.report_interval))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,199 @@
+import re
+import sys
+import numpy as np
+
+"""
+Streaming analyzer for the logs fetched by harvestData.sh.
+
+Usage:
+  python3 analyze.py driver driver.log
+  python3 analyze.py function function.log
+
+The log is read in blocks of BLOCK_SIZE bytes, so memory stays bounded however large the log is. Each block is
+scanned with one regex pass and the matched fields are converted to NumPy arrays and accumulated into:
+  - exact counts per millisecond value (latencies are logged as integer msec), from which the 100 msec
+    frequency distribution and exact percentiles are derived
+  - for the driver log, echoes received per second, from the send time and latency of each message
+
+Files written to the current directory, where NAME is driver or function:
+  NAME_time_frequencies.txt - "bucket count" per 100 msec bucket, a latency of 101-200 msec is counted in bucket 200
+  NAME_percentiles.txt - count, min, mean, p50, p90, p99, p99.9 and max in msec
+  driver_throughput.csv - second,echoes for each second of the run (driver only)
+  NAME_latency.npy - the exact counts as a 2 x N int64 array of msec values and their counts, read by runstore.py
+
+driver line format (text and binary payloads)
+[2019-01-04 21:08:53,492] locust-worker-0/INFO/stdout: *** ON_MESSAGE LTK00017 0x7f79587c47d0 payload 200 at 154663613324524 ack latency 247 msec
+[2019-01-04 21:08:53,492] locust-worker-0/INFO/stdout: *** ON_MESSAGE b'LTK00017 0x7f79587c47d0 payload 200 at 154663613324524 ack' latency 247 msec
+The send time is in tens of microseconds since the epoch.
+
+function line format
+347857302674139 Function execution took 883 ms, finished with status: 'ok'
+"""
+
+BLOCK_SIZE = 16 * 1024 * 1024
+BUCKET = 100
+PERCENTILES = (50, 90, 99, 99.9)
+
+# anything between the send time and the latency (padding, ack, hop timestamps) is skipped
+DRIVER_LINE = re.compile(rb"ON_MESSAGE b?'?\S+ \S+ payload \d+ at (\d+) .*?latency (\d+) msec")
+FUNCTION_LINE = re.compile(rb'Function execution took (\d+) ms')
+
+
+def read_blocks(path, blockSize=BLOCK_SIZE):
+    # Yields blocks of whole lines.
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            data = f.read(blockSize)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                rest = data
+                continue
+            rest = data[end:]
+            yield data[:end]
+        if rest:
+            yield rest
+
+
+class Distribution(object):
+    # Exact counts of integer millisecond values.
+
+    def __init__(self):
+        self.counts = np.zeros(1024, dtype=np.int64)
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        counts = np.bincount(values)
+        if len(counts) > len(self.counts):
+            grown = np.zeros(max(len(counts), 2 * len(self.counts)), dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        self.counts[:len(counts)] += counts
+
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, p):
+        # smallest value at or below which p percent of the values fall (nearest rank), None without values
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            return None
+        rank = max(1, int(np.ceil(cumulative[-1] * p / 100.0)))
+        return int(np.searchsorted(cumulative, rank))
+
+    def buckets(self):
+        # (bucket, count) per 100 msec bucket that has values, binned as harvestData.sh always did: 0 -> 0,
+        # 1..100 -> 100, 101..200 -> 200 ...
+        values = np.nonzero(self.counts)[0]
+        bucketOf = (values + BUCKET - 1) // BUCKET * BUCKET
+        bucketCounts = np.bincount(bucketOf // BUCKET, weights=self.counts[values]).astype(np.int64)
+        return [(i * BUCKET, int(n)) for i, n in enumerate(bucketCounts) if n]
+
+    def sparse(self):
+        # 2 x N array of the values that occur and their counts
+        values = np.nonzero(self.counts)[0]
+        return np.vstack([values, self.counts[values]])
+
+    @classmethod
+    def from_sparse(cls, sparse):
+        d = cls()
+        if sparse.shape[1]:
+            d.counts = np.zeros(int(sparse[0, -1]) + 1, dtype=np.int64)
+            d.counts[sparse[0]] = sparse[1]
+        return d
+
+    def summary(self):
+        n = self.count()
+        if n == 0:
+            return {'count': 0}
+        values = np.nonzero(self.counts)[0]
+        s = {
+            'count': n,
+            'min': int(values[0]),
+            'mean': float(np.dot(values, self.counts[values])) / n,
+            'max': int(values[-1]),
+        }
+        for p in PERCENTILES:
+            s['p{:g}'.format(p)] = self.percentile(p)
+        return s
+
+
+class Throughput(object):
+    # Echoes received per second, keyed by epoch second.
+
+    def __init__(self):
+        self.perSecond = {}
+
+    def add(self, seconds):
+        if len(seconds) == 0:
+            return
+        keys, counts = np.unique(seconds, return_counts=True)
+        for k, n in zip(keys.tolist(), counts.tolist()):
+            self.perSecond[k] = self.perSecond.get(k, 0) + n
+
+    def series(self):
+        # every second from the first to the last echo, including seconds with none
+        if not self.perSecond:
+            return []
+        first, last = min(self.perSecond), max(self.perSecond)
+        return [(s, self.perSecond.get(s, 0)) for s in range(first, last + 1)]
+
+
+def analyze_driver(path):
+    latencies = Distribution()
+    throughput = Throughput()
+    for block in read_blocks(path):
+        fields = DRIVER_LINE.findall(block)
+        if not fields:
+            continue
+        a = np.array(fields, dtype=np.int64)
+        sendTimes, latency = a[:, 0], a[:, 1]
+        latencies.add(latency)
+        # receive time in tens of microseconds, to seconds
+        throughput.add((sendTimes + latency * 100) // 100000)
+    return latencies, throughput
+
+
+def analyze_function(path):
+    latencies = Distribution()
+    for block in read_blocks(path):
+        fields = FUNCTION_LINE.findall(block)
+        if fields:
+            latencies.add(np.array(fields, dtype=np.int64))
+    return latencies
+
+
+def write_report(name, latencies):
+    with open('{}_time_frequencies.txt'.format(name), 'w') as f:
+        for bucket, n in latencies.buckets():
+            f.write('{} {}\n'.format(bucket, n))
+    s = latencies.summary()
+    with open('{}_percentiles.txt'.format(name), 'w') as f:
+        for key in ['count', 'min', 'mean'] + ['p{:g}'.format(p) for p in PERCENTILES] + ['max']:
+            if key in s:
+                f.write('{} {}\n'.format(key, round(s[key], 1) if key == 'mean' else s[key]))
+    np.save('{}_latency.npy'.format(name), latencies.sparse())
+
+
+def main(argv):
+    if len(argv) != 3 or argv[1] not in ('driver', 'function'):
+        sys.stderr.write('usage: {} driver|function LOG\n'.format(argv[0]))
+        return 2
+    name, path = argv[1], argv[2]
+    if name == 'driver':
+        latencies, throughput = analyze_driver(path)
+        with open('driver_throughput.csv', 'w') as f:
+            for second, n in throughput.series():
+                f.write('{},{}\n'.format(second, n))
+    else:
+        latencies = analyze_function(path)
+    write_report(name, latencies)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
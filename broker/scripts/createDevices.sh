@@ -8,7 +8,8 @@
 #   MIN_SEQ is sequence number of first device to create
 #   MAX_SEQ is sequence number of last device to create
 #
-# The deviceIds and private keys are written to devicelist.csv in the ltk root directory.
+# The deviceIds and private keys are written to devicelist.csv in the ltk root directory, and the compact store
+# devicelist.db is built from it.
 #
 # To create an initial device population, set:
 #   MIN_SEQ to 1
@@ -17,36 +18,13 @@
 # To add more devices to an existing device population, set:
 #   MIN_SEQ to the next highest unused device sequence number
 #   MAX_SEQ to the total desired number of devices after the new devices are added
+#
+# The devices are created by provision.py (next to this script, needs python3, cryptography and
+# google-api-python-client), which generates the keys in parallel and registers devices concurrently. If it is
+# interrupted, run the same command again, devices already in devicelist.csv are skipped.
 
 MIN_SEQ=$1
 MAX_SEQ=$2
+SCRIPT_DIR=$(cd $(dirname $0) && pwd)
 
-function info {
-  echo "LTK: $1"
-}
-
-info "creating devices LTK$(printf "%05d" $MIN_SEQ) through LTK$(printf "%05d" $MAX_SEQ)"
-for i in `seq $MIN_SEQ $MAX_SEQ`; do
-
-  deviceId=LTK$(printf "%05d" $i)
-
-  openssl genrsa -out private_key.pem 2048 1>/dev/null 2>&1
-  openssl rsa -in private_key.pem -pubout -out public_key.pem 1>/dev/null 2>&1
-
-  gcloud iot devices create $deviceId \
-    --project=$LTK_TARGET_PROJECT_ID \
-    --region=$LTK_TARGET_REGION \
-    --registry=$LTK_TARGET_REGISTRY_ID \
-    --public-key path=public_key.pem,type=rsa-pem
-  if [[ $? -eq 0 ]]; then
-    csvline="$deviceId,`cat private_key.pem`"
-    echo $csvline >> $LTK_ROOT/devicelist.csv
-  fi
-
-  rm private_key.pem
-  rm public_key.pem
-  
-done
-
-
-
+python3 $SCRIPT_DIR/provision.py create $MIN_SEQ $MAX_SEQ --root $LTK_ROOT
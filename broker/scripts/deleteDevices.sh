@@ -3,28 +3,14 @@
 # Deletes devices from a GCP IoT registry.
 #
 # Usage:
-#   ./createDevices.sh
+#   ./deleteDevices.sh
 #
-# The deviceIds to delete are read from devicelist.csv in the ltk root directory.
-
-function info {
-  echo "LTK: $1"
-}
-
-while IFS=',' read deviceId rest; do
-
-  gcloud iot devices delete $deviceId \
-    --project=$LTK_TARGET_PROJECT_ID \
-    --region=$LTK_TARGET_REGION \
-    --registry=$LTK_TARGET_REGISTRY_ID \
-    --quiet
-
-done < $LTK_ROOT/devicelist.csv
-
-# All the devices are deleted so delete this devicelist.
-info "Devices deleted from GCP, deleting $LTK_ROOT/devicelist.csv"
-rm $LTK_ROOT/devicelist.csv
-
-
+# The deviceIds to delete are read from devicelist.csv in the ltk root directory. Once all the devices are deleted,
+# devicelist.csv and devicelist.db are deleted.
+#
+# The devices are deleted concurrently by provision.py (next to this script). If it is interrupted or some deletes
+# fail, run it again, devices already deleted are skipped.
 
+SCRIPT_DIR=$(cd $(dirname $0) && pwd)
 
+python3 $SCRIPT_DIR/provision.py delete --root $LTK_ROOT
@@ -18,8 +18,15 @@
 #   Function times - frequency distribution of function execution times
 #
 #   Distributions are bucketed to 100msec increments.
+#
+# The logs are analyzed by analyze.py (next to this script, needs python3 and numpy), which streams them in blocks
+# and also writes exact percentiles (*_percentiles.txt) and the echoes received per second (driver_throughput.csv).
+#
+# The run is then saved to the indexed store in LTK_ROOT/runs/store by runstore.py, with its configuration, so runs
+# can be compared with "python3 runstore.py compare BASE_RUN RUN".
 
 RUN_DIR=$1
+SCRIPT_DIR=$(cd $(dirname $0) && pwd)
 START_TIME=$2
 END_TIME=$3
 
@@ -43,10 +50,15 @@ if [ -d $RESULTS_DIR ]; then
   rm driver_times_binned.csv >/dev/null 2>&1 || true
   rm driver_times_sorted.csv >/dev/null 2>&1 || true
   rm driver_time_frequencies.txt >/dev/null 2>&1 || true
+  rm driver_percentiles.txt >/dev/null 2>&1 || true
+  rm driver_throughput.csv >/dev/null 2>&1 || true
+  rm driver_latency.npy >/dev/null 2>&1 || true
   rm function_times.csv >/dev/null 2>&1 || true
   rm function_times_binned.csv >/dev/null 2>&1 || true
   rm function_times_sorted.csv >/dev/null 2>&1 || true
   rm function_time_frequencies.txt >/dev/null 2>&1 || true
+  rm function_percentiles.txt >/dev/null 2>&1 || true
+  rm function_latency.npy >/dev/null 2>&1 || true
 else
   # Create results directory.
   info "Creating $RESULTS_DIR"
@@ -77,31 +89,11 @@ gcloud logging read \
 
 # Put the driver times into 100msec bins for reporting frequency distribution.
 
-# Extract needed fields from the driver.log download.
 # driver line format
 # [2019-01-04 21:08:53,492] locust-worker-0/INFO/stdout: *** ON_MESSAGE LTK00017 0x7f79587c47d0 payload 200 at 154663613324524 ack latency 247 msec
 
-awk NF driver.log | awk -v OFS=',' '{print $6,$11,$14}' > driver_times.csv
-
-# For each line in the driver_extract, bin the driver time.
-info "Binning driver times"
-while IFS=',' read deviceId requestId driverTime; do
-  if [[ $(( driverTime % 100 )) -eq 0 ]]; then
-    driverTimeBucket=$driverTime
-  else
-    driverTimeBucket=$(( (driverTime/100 + 1) * 100 ))
-  fi
-  csvline=$deviceId,$requestId,$driverTime,$driverTimeBucket
-  echo $csvline >> driver_times_binned.csv
-done < driver_times.csv
-
-# Get frequency distributions of driver times.
-
-awk -F',' '{print $4}' driver_times_binned.csv | sort -n | uniq -c | sort -n -k2 | awk '{print $2, $1}' > driver_time_frequencies.txt
-
-# Create sorted lists of driver times for analysis.
-
-cat driver_times.csv | sort -n -t ',' -k3 > driver_times_sorted.csv
+info "Analyzing driver times"
+python3 $SCRIPT_DIR/analyze.py driver driver.log || errorExit "Unable to analyze driver log"
 
 # Display frequency distribution.
 
@@ -109,6 +101,8 @@ echo "**********************************"
 echo "Driver Time Frequency Distribution"
 echo ""
 cat driver_time_frequencies.txt
+echo ""
+cat driver_percentiles.txt
 
 #
 # Harvest function data
@@ -132,29 +126,9 @@ if [ "$HARVEST_FUNCTION_DATA" = true ]; then
 
   # function line format
   # 347857302674139 Function execution took 883 ms, finished with status: 'ok'
-  # Extract needed fields from the function.log download.
-
-  grep "Function execution took" function.log | awk -v OFS=',' '{print $1,$5}' > function_times.csv
 
-  # For each line in the function_extract, bin the function time.
-  info "Binning function times"
-  while IFS=',' read executionId functionTime; do
-    if [[ $(( functionTime % 100 )) -eq 0 ]]; then
-      functionTimeBucket=$functionTime
-    else
-      functionTimeBucket=$(( (functionTime/100 + 1) * 100 ))
-    fi
-    csvline=$executionId,$functionTime,$functionTimeBucket
-    echo $csvline >> function_times_binned.csv
-  done < function_times.csv
-
-  # Get frequency distributions of function times.
-
-  awk -F',' '{print $3}' function_times_binned.csv | sort -n | uniq -c | sort -n -k2 | awk '{print $2, $1}' > function_time_frequencies.txt
-
-  # Create sorted lists of driver and function times for analysis.
-
-  cat function_times.csv | sort -n -t ',' -k3 > function_times_sorted.csv
+  info "Analyzing function times"
+  python3 $SCRIPT_DIR/analyze.py function function.log || errorExit "Unable to analyze function log"
 
   # Display frequency distributions.
 
@@ -162,5 +136,13 @@ if [ "$HARVEST_FUNCTION_DATA" = true ]; then
   echo "Function Time Frequency Distribution"
   echo ""
   cat function_time_frequencies.txt
+  echo ""
+  cat function_percentiles.txt
 fi
 
+#
+# Save the run to the run store
+#
+
+info "Saving run $RUN_DIR to $LTK_ROOT/runs/store"
+python3 $SCRIPT_DIR/runstore.py save $RUN_DIR --start $START_TIME --end $END_TIME || errorExit "Unable to save run"
@@ -0,0 +1,279 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+"""
+Parallel bulk device provisioning, used by createDevices.sh and deleteDevices.sh.
+
+Usage:
+  python3 provision.py create MIN_SEQ MAX_SEQ [--registry cloudiot|noop]
+  python3 provision.py delete [--registry cloudiot|noop]
+
+create generates an RSA 2048 keypair per device in a process pool (--key-processes, default all cores) and registers
+the devices LTK{MIN_SEQ} .. LTK{MAX_SEQ} with --concurrency (default 32) threads, each keeping its own HTTP
+connection to the registry. Keys for the next batch are generated while the current batch registers. Requests that
+fail with 429 or 5xx, or with a connection error, are retried with exponential backoff and jitter (--retries, default
+6). A device that already exists, left by an interrupted run, gets the new key through a credentials patch.
+
+devicelist.csv in LTK_ROOT is the checkpoint: a device's line (deviceId and the flattened private key, as before) is
+appended and flushed as soon as it is registered, and devices already in the file are skipped, so an interrupted run
+is resumed by running the same command again. At the end the compact store devicelist.db, which the workers map
+directly (see benchmark/k8s/apps/devicestore.py), is written next to it.
+
+delete removes the devices of devicelist.csv the same way, 404 counts as deleted. Deleted ids are appended to
+devicelist.csv.deleted so an interrupted delete resumes, and the device files are removed once every device is gone.
+
+The cloudiot registry is LTK_TARGET_PROJECT_ID, LTK_TARGET_REGION and LTK_TARGET_REGISTRY_ID, with application
+default credentials. The noop registry only sleeps --noop-latency-ms per request and fails --noop-error-rate of them
+with a 503, for running the tool offline.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmark', 'k8s', 'apps'))
+import devicestore  # noqa: E402
+
+RETRYABLE = (429, 500, 502, 503, 504)
+BATCH_SIZE = 1000
+
+
+def info(msg):
+    sys.stdout.write('LTK: {}\n'.format(msg))
+    sys.stdout.flush()
+
+
+def device_id(seq):
+    return 'LTK{:05d}'.format(seq)
+
+
+def generate_keypair(deviceId):
+    # runs in the key pool, same key as "openssl genrsa 2048" and its public key as "openssl rsa -pubout"
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    private = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption()).decode('ascii')
+    public = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                           serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+    return deviceId, private, public
+
+
+class RegistryError(Exception):
+
+    def __init__(self, status, msg):
+        super(RegistryError, self).__init__('{} {}'.format(status, msg))
+        self.status = status
+
+
+class CloudIotRegistry(object):
+
+    def __init__(self, projectId, region, registryId):
+        import google.auth
+        from googleapiclient import discovery
+        self.credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+        self.client = discovery.build(
+            'cloudiot', 'v1', credentials=self.credentials, cache_discovery=False, discoveryServiceUrl=(
+                'https://cloudiot.googleapis.com/$discovery/rest'))
+        self.registryName = 'projects/{}/locations/{}/registries/{}'.format(projectId, region, registryId)
+        self.local = threading.local()
+
+    def http(self):
+        # httplib2 is not thread safe, every registering thread keeps its own connection
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+            http = self.local.http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return http
+
+    def execute(self, request):
+        from googleapiclient.errors import HttpError
+        try:
+            return request.execute(http=self.http())
+        except HttpError as e:
+            raise RegistryError(e.resp.status, e._get_reason())
+
+    def create(self, deviceId, publicKey):
+        credentials = [{'publicKey': {'format': 'RSA_PEM', 'key': publicKey}}]
+        devices = self.client.projects().locations().registries().devices()
+        try:
+            self.execute(devices.create(parent=self.registryName, body={'id': deviceId, 'credentials': credentials}))
+        except RegistryError as e:
+            if e.status != 409:
+                raise
+            # left by an interrupted run without its key in the csv, replace the key
+            self.execute(devices.patch(name='{}/devices/{}'.format(self.registryName, deviceId),
+                                       updateMask='credentials', body={'credentials': credentials}))
+
+    def delete(self, deviceId):
+        devices = self.client.projects().locations().registries().devices()
+        try:
+            self.execute(devices.delete(name='{}/devices/{}'.format(self.registryName, deviceId)))
+        except RegistryError as e:
+            if e.status != 404:
+                raise
+
+
+class NoopRegistry(object):
+
+    def __init__(self, latencyMs=0, errorRate=0.0):
+        self.latency = latencyMs / 1000.0
+        self.errorRate = errorRate
+
+    def request(self):
+        time.sleep(self.latency)
+        if random.random() < self.errorRate:
+            raise RegistryError(503, 'noop registry failure')
+
+    def create(self, deviceId, publicKey):
+        self.request()
+
+    def delete(self, deviceId):
+        self.request()
+
+
+def with_retry(call, retries, *args):
+    # exponential backoff with full jitter, 0.5 sec base and 30 sec cap
+    for attempt in range(retries + 1):
+        try:
+            return call(*args)
+        except (RegistryError, OSError) as e:
+            if attempt == retries or (isinstance(e, RegistryError) and e.status not in RETRYABLE):
+                raise
+            time.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+
+
+def read_ids(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(line.split(',', 1)[0].strip() for line in f if line.strip())
+
+
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Progress(object):
+
+    def __init__(self, action, total, interval=10):
+        self.action = action
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self.nextReport = self.start + interval
+
+    def count(self, ok):
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        now = time.time()
+        if now >= self.nextReport:
+            self.nextReport = now + self.interval
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        info('{} {} of {} devices, {} failed, {:.1f} devices/s'
+             .format(self.action, self.done, self.total, self.failed, self.done / max(elapsed, 0.001)))
+
+
+def create(args, registry, root):
+    csvPath = os.path.join(root, 'devicelist.csv')
+    existing = read_ids(csvPath)
+    todo = [device_id(i) for i in range(args.min_seq, args.max_seq + 1) if device_id(i) not in existing]
+    info('creating devices {} through {}, {} already in devicelist.csv'
+         .format(device_id(args.min_seq), device_id(args.max_seq), args.max_seq - args.min_seq + 1 - len(todo)))
+    progress = Progress('created', len(todo))
+    with ProcessPoolExecutor(args.key_processes) as keyPool, ThreadPoolExecutor(args.concurrency) as sendPool, \
+            open(csvPath, 'a') as out:
+        pending = [keyPool.submit(generate_keypair, d) for d in todo[:BATCH_SIZE]]
+        for i, batch in enumerate(batches(todo, BATCH_SIZE)):
+            keys = [f.result() for f in pending]
+            # generate the next batch's keys while this one registers
+            pending = [keyPool.submit(generate_keypair, d) for d in todo[(i + 1) * BATCH_SIZE:(i + 2) * BATCH_SIZE]]
+            futures = {sendPool.submit(with_retry, registry.create, args.retries, d, public): (d, private)
+                       for d, private, public in keys}
+            for f in as_completed(futures):
+                deviceId, private = futures[f]
+                try:
+                    f.result()
+                except Exception as e:
+                    info('failed to create {}: {}'.format(deviceId, e))
+                    progress.count(False)
+                    continue
+                out.write('{},{}\n'.format(deviceId, ' '.join(private.split())))
+                out.flush()
+                progress.count(True)
+    progress.report()
+    n = devicestore.build(csvPath, os.path.join(root, 'devicelist.db'))
+    info('wrote {} devices to {}'.format(n, os.path.join(root, 'devicelist.db')))
+    return 1 if progress.failed else 0
+
+
+def delete(args, registry, root):
+    csvPath = os.path.join(root, 'devicelist.csv')
+    deletedPath = csvPath + '.deleted'
+    deleted = read_ids(deletedPath)
+    todo = sorted(read_ids(csvPath) - deleted)
+    info('deleting {} devices, {} already deleted'.format(len(todo), len(deleted)))
+    progress = Progress('deleted', len(todo))
+    with ThreadPoolExecutor(args.concurrency) as sendPool, open(deletedPath, 'a') as out:
+        futures = {sendPool.submit(with_retry, registry.delete, args.retries, d): d for d in todo}
+        for f in as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                info('failed to delete {}: {}'.format(futures[f], e))
+                progress.count(False)
+                continue
+            out.write(futures[f] + '\n')
+            out.flush()
+            progress.count(True)
+    progress.report()
+    if progress.failed:
+        info('{} devices were not deleted, run again to retry them'.format(progress.failed))
+        return 1
+    # All the devices are deleted so delete this devicelist.
+    info('Devices deleted, deleting {} and devicelist.db'.format(csvPath))
+    for p in (csvPath, deletedPath, os.path.join(root, 'devicelist.db')):
+        if os.path.exists(p):
+            os.remove(p)
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Create or delete the benchmark devices in bulk.')
+    parser.add_argument('action', choices=('create', 'delete'))
+    parser.add_argument('min_seq', type=int, nargs='?', help='sequence number of the first device to create')
+    parser.add_argument('max_seq', type=int, nargs='?', help='sequence number of the last device to create')
+    parser.add_argument('--registry', choices=('cloudiot', 'noop'), default='cloudiot')
+    parser.add_argument('--root', default=os.environ.get('LTK_ROOT') or '.', help='directory of devicelist.csv')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent registry requests')
+    parser.add_argument('--key-processes', type=int, default=None, help='key generation processes')
+    parser.add_argument('--retries', type=int, default=6, help='retries of a failed registry request')
+    parser.add_argument('--noop-latency-ms', type=float, default=0)
+    parser.add_argument('--noop-error-rate', type=float, default=0.0)
+    args = parser.parse_args(argv[1:])
+    if args.action == 'create' and (args.min_seq is None or args.max_seq is None):
+        parser.error('create needs MIN_SEQ and MAX_SEQ')
+
+    if args.registry == 'noop':
+        registry = NoopRegistry(args.noop_latency_ms, args.noop_error_rate)
+    else:
+        registry = CloudIotRegistry(os.environ['LTK_TARGET_PROJECT_ID'], os.environ['LTK_TARGET_REGION'],
+                                    os.environ['LTK_TARGET_REGISTRY_ID'])
+    if args.action == 'create':
+        return create(args, registry, args.root)
+    return delete(args, registry, args.root)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
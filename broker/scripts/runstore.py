@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from analyze import Distribution
+
+"""
+Indexed store of harvested runs, and cross-run comparison.
+
+Usage:
+  python3 runstore.py save RUN_DIR [--start START_TIME] [--end END_TIME] [--set KEY=VALUE ...]
+  python3 runstore.py list [--where KEY=VALUE ...]
+  python3 runstore.py compare BASE_RUN [RUN ...] [--where KEY=VALUE ...] [--threshold 0.1] [--min-ms 5]
+
+The store is $LTK_ROOT/runs/store (or --store). save is run by harvestData.sh in the run's directory once analyze.py
+has written its files, and keeps for the run:
+  RUN.npz - the exact driver and function latency counts (msec values and counts, from NAME_latency.npy) and the
+    driver throughput series (second and echoes, from driver_throughput.csv) as compressed NumPy arrays
+  an entry in index.json - the run's configuration and a summary (count, mean, p50, p90, p99, p99.9, max per latency
+    kind, mean and peak echoes/s)
+The configuration is every LTK_* variable, the GKE node count and machine type, the worker settings that shape the
+load (payload, QoS, publish mode and rate, broker backend and host, workload profile) when set, the number of devices in
+$LTK_ROOT/devicelist.csv, the harvest window, and KEY=VALUE pairs given with --set, which override them.
+
+list prints the index. compare reads the index, loads the .npz of only the runs it compares and prints, for each
+run against BASE_RUN, the percentile deltas of each latency kind and the throughput delta. A percentile more than
+--threshold (fraction) and --min-ms msec above the base, or a mean throughput more than --threshold below it, is
+flagged as REGRESSION and the exit status is 1. Runs are the RUN arguments, or every run matching --where.
+"""
+
+INDEX = 'index.json'
+KINDS = ('driver', 'function')
+PERCENTILES = (50, 90, 99, 99.9)
+CONFIG_ENV = ('GKE_NODE_COUNT', 'GKE_NODE_MACHINE_TYPE', 'PAYLOAD_FORMAT', 'PAYLOAD_SIZE', 'PUBLISH_QOS',
+              'SUBSCRIBE_QOS', 'PUBLISH_MODE', 'PUBLISH_RATE', 'FLEET_PUBLISH_RATE', 'MQTT_BACKEND', 'MQTT_HOST',
+              'WORKLOAD_PROFILE')
+
+
+def default_store():
+    return os.path.join(os.environ.get('LTK_ROOT') or '.', 'runs', 'store')
+
+
+def load_index(store):
+    path = os.path.join(store, INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_index(store, index):
+    # written to a temporary file and renamed, so a crash never leaves a truncated index
+    path = os.path.join(store, INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def parse_pairs(pairs):
+    result = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition('=')
+        result[key] = value
+    return result
+
+
+def run_config(args):
+    config = dict((k, v) for k, v in os.environ.items() if k.startswith('LTK_') and k != 'LTK_ROOT')
+    config.update((k, os.environ[k]) for k in CONFIG_ENV if os.environ.get(k))
+    deviceList = os.path.join(os.environ.get('LTK_ROOT') or '.', 'devicelist.csv')
+    if os.path.exists(deviceList):
+        with open(deviceList, 'rb') as f:
+            config['devices'] = str(sum(1 for _ in f))
+    if args.start:
+        config['start'] = args.start
+    if args.end:
+        config['end'] = args.end
+    config.update(parse_pairs(args.set))
+    return config
+
+
+def throughput_summary(series):
+    if len(series) == 0:
+        return {}
+    echoes = series[:, 1]
+    return {'seconds': int(len(echoes)), 'mean': float(echoes.mean()), 'peak': int(echoes.max())}
+
+
+def save(args):
+    os.makedirs(args.store, exist_ok=True)
+    arrays = {}
+    summary = {}
+    for kind in KINDS:
+        path = '{}_latency.npy'.format(kind)
+        if os.path.exists(path):
+            arrays[kind] = np.load(path)
+            summary[kind] = Distribution.from_sparse(arrays[kind]).summary()
+    if os.path.exists('driver_throughput.csv') and os.path.getsize('driver_throughput.csv'):
+        arrays['throughput'] = np.loadtxt('driver_throughput.csv', delimiter=',', dtype=np.int64, ndmin=2)
+        summary['throughput'] = throughput_summary(arrays['throughput'])
+    if not arrays:
+        sys.stderr.write('no analyze.py output in {}\n'.format(os.getcwd()))
+        return 2
+    np.savez_compressed(os.path.join(args.store, args.run + '.npz'), **arrays)
+    index = load_index(args.store)
+    index[args.run] = {'config': run_config(args), 'summary': summary, 'saved': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    write_index(args.store, index)
+    sys.stdout.write('LTK: saved run {} to {}\n'.format(args.run, args.store))
+    return 0
+
+
+def matching(index, where):
+    conditions = parse_pairs(where)
+    return sorted(run for run, entry in index.items()
+                  if all(entry['config'].get(k) == v for k, v in conditions.items()))
+
+
+def list_runs(args):
+    index = load_index(args.store)
+    for run in matching(index, args.where):
+        entry = index[run]
+        driver = entry['summary'].get('driver', {})
+        throughput = entry['summary'].get('throughput', {})
+        sys.stdout.write('{:<24} devices {:>7} workers {:>4} p50 {:>6} p99 {:>6} msec {:>9.1f} echoes/s  {}\n'
+                         .format(run, entry['config'].get('devices', '-'),
+                                 entry['config'].get('LTK_NUM_LOCUST_WORKERS', '-'), driver.get('p50', '-'),
+                                 driver.get('p99', '-'), throughput.get('mean', 0.0), entry['config'].get('start', '')))
+    return 0
+
+
+def load_run(store, run):
+    with np.load(os.path.join(store, run + '.npz')) as data:
+        return dict((name, data[name]) for name in data.files)
+
+
+def compare(args):
+    index = load_index(args.store)
+    if args.base not in index:
+        sys.stderr.write('unknown run {}\n'.format(args.base))
+        return 2
+    runs = args.runs or [r for r in matching(index, args.where) if r != args.base]
+    missing = [r for r in runs if r not in index]
+    if missing:
+        sys.stderr.write('unknown runs {}\n'.format(', '.join(missing)))
+        return 2
+    percentiles = PERCENTILES + tuple(p for p in args.percentile if p not in PERCENTILES)
+    base = load_run(args.store, args.base)
+    regressions = 0
+    for run in runs:
+        data = load_run(args.store, run)
+        sys.stdout.write('*** {} vs {}\n'.format(run, args.base))
+        for kind in KINDS:
+            if kind not in base or kind not in data:
+                continue
+            b = Distribution.from_sparse(base[kind])
+            r = Distribution.from_sparse(data[kind])
+            if b.count() == 0 or r.count() == 0:
+                # an empty log in the harvest window, e.g. no function lines, has nothing to compare
+                sys.stdout.write('  {:<8} no data in {}\n'.format(kind, ' and '.join(
+                    name for name, d in ((args.base, b), (run, r)) if d.count() == 0)))
+                continue
+            cells = []
+            for p in percentiles + (100,):
+                bv, rv = b.percentile(p), r.percentile(p)
+                flagged = p != 100 and rv - bv > max(args.min_ms, bv * args.threshold)
+                regressions += flagged
+                cells.append('{} {} -> {} ({:+.1%}){}'.format('max' if p == 100 else 'p{:g}'.format(p), bv, rv,
+                                                            (rv - bv) / bv if bv else 0.0, ' REGRESSION' if flagged else ''))
+            sys.stdout.write('  {:<8} {}\n'.format(kind, ', '.join(cells)))
+        if 'throughput' in base and 'throughput' in data:
+            bt = throughput_summary(base['throughput'])
+            rt = throughput_summary(data['throughput'])
+            flagged = rt['mean'] < bt['mean'] * (1 - args.threshold)
+            regressions += flagged
+            sys.stdout.write('  {:<8} mean {:.1f} -> {:.1f} echoes/s ({:+.1%}), peak {} -> {}{}\n'
+                             .format('echoes', bt['mean'], rt['mean'], (rt['mean'] - bt['mean']) / bt['mean'] if bt['mean'] else 0.0,
+                                     bt['peak'], rt['peak'], ' REGRESSION' if flagged else ''))
+        changed = dict((k, v) for k, v in index[run]['config'].items()
+                       if index[args.base]['config'].get(k) != v and k not in ('start', 'end'))
+        if changed:
+            sys.stdout.write('  config   {}\n'.format(' '.join('{}={}'.format(k, v) for k, v in sorted(changed.items()))))
+    if regressions:
+        sys.stdout.write('*** {} regressions against {}\n'.format(regressions, args.base))
+    return 1 if regressions else 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Store harvested runs and compare them.')
+    parser.add_argument('--store', default=default_store(), help='store directory (default $LTK_ROOT/runs/store)')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('save', help='save the analyze.py output in the current directory as a run')
+    p.add_argument('run')
+    p.add_argument('--start')
+    p.add_argument('--end')
+    p.add_argument('--set', action='append', help='KEY=VALUE added to the run configuration')
+    p = commands.add_parser('list', help='list the stored runs')
+    p.add_argument('--where', action='append', help='only runs whose configuration has KEY=VALUE')
+    p = commands.add_parser('compare', help='compare runs against a base run')
+    p.add_argument('base')
+    p.add_argument('runs', nargs='*')
+    p.add_argument('--where', action='append', help='compare every run whose configuration has KEY=VALUE')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    p.add_argument('--min-ms', type=int, default=5, help='smallest latency increase in msec flagged')
+    p.add_argument('--percentile', type=float, action='append', default=[], help='additional percentile to compare')
+    args = parser.parse_args(argv[1:])
+    if args.command == 'save':
+        return save(args)
+    if args.command == 'list':
+        return list_runs(args)
+    if args.command == 'compare':
+        return compare(args)
+    parser.print_usage(sys.stderr)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))